@@ -1,5 +1,5 @@
-import pygame, sys
-from modules import user_system, pack_opening, squad_builder, market
+import argparse, pygame, sys
+from modules import client, user_system, pack_opening, squad_builder
 
 pygame.init()
 WIDTH, HEIGHT = 900, 600
@@ -72,7 +72,7 @@ def main_menu():
     while running:
         WIN.fill(GRAY)
         WIN.blit(BIG_FONT.render(f"Welcome {CURRENT_USER}",True,(0,0,0)),(50,20))
-        WIN.blit(FONT.render(f"Coins: {user_system.load_users()[CURRENT_USER]['coins']}",True,(0,0,0)),(50,60))
+        WIN.blit(FONT.render(f"Coins: {user_system.get_coins(CURRENT_USER)}",True,(0,0,0)),(50,60))
         draw_button("Buy Pack",50,120,200,50,GOLD)
         draw_button("Squad Builder",50,200,200,50,WHITE)
         draw_button("Market",50,280,200,50,WHITE)
@@ -96,7 +96,14 @@ def main_menu():
         clock.tick(60)
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="FUT Placeholder")
+    parser.add_argument("--server", nargs="?", const=":%d" % client.ADDRESS[1], metavar="HOST:PORT",
+                        help="play through a market server (python -m modules.server) instead of the local database")
+    args = parser.parse_args()
+    if args.server:
+        client.use_server(client.parse_address(args.server))
     login_screen()
     main_menu()
+    user_system.flush()
     pygame.quit()
     sys.exit()
@@ -0,0 +1,118 @@
+"""Client side of modules.server.
+
+    client = Client()                      # or Client(("127.0.0.1", 5055))
+    client.call("market.buy_card", "bob", 7)
+
+use_server() plugs a Client into the game itself: main.py calls it for
+--server, after which user_system, market, squad_builder and
+pack_opening talk to the server instead of the local database.  AsyncClient is the asyncio
+version, for many simultaneous clients in one process (see
+server_bench.py).
+"""
+import asyncio, json, socket, threading
+from modules import market, pack_opening, squad_builder, user_system
+from modules.server import ADDRESS, EXPOSED, LINE_LIMIT, encode
+
+class RemoteError(Exception):
+    """The operation raised on the server; the message names the exception."""
+
+def parse_address(text):
+    """(host, port) from "host:port", ":port" or "port"."""
+    host, _, port = text.rpartition(":")
+    return host or ADDRESS[0], int(port)
+
+def _result(reply):
+    if "error" in reply:
+        raise RemoteError(reply["error"])
+    return reply["result"]
+
+class Client:
+    """A blocking connection; calls from several threads take turns."""
+
+    def __init__(self, address=ADDRESS, timeout=30):
+        self._sock = socket.create_connection(address, timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def call(self, op, *args, **kwargs):
+        with self._lock:
+            self._next += 1
+            self._sock.sendall(encode({"id": self._next, "op": op, "args": args, "kwargs": kwargs}))
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError("the server closed the connection")
+        return _result(json.loads(line))
+
+    def function(self, op):
+        """`op` as a plain function, e.g. function("user_system.get_coins")("bob")."""
+        def call(*args, **kwargs):
+            return self.call(op, *args, **kwargs)
+        call.__name__ = op.rpartition(".")[2]
+        return call
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+class AsyncClient:
+    """An asyncio connection.  Calls don't wait for each other: requests
+    are written as they come and replies matched up by id."""
+
+    def __init__(self, reader, writer):
+        self._writer = writer
+        self._waiting = {}
+        self._next = 0
+        self._reading = asyncio.ensure_future(self._read(reader))
+
+    @classmethod
+    async def connect(cls, address=ADDRESS):
+        reader, writer = await asyncio.open_connection(*address, limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                future = self._waiting.pop(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except ConnectionError:
+            pass
+        finally:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("the server closed the connection"))
+            self._waiting.clear()
+
+    async def call(self, op, *args, **kwargs):
+        if self._reading.done():
+            raise ConnectionError("the server closed the connection")
+        self._next += 1
+        future = self._waiting[self._next] = asyncio.get_running_loop().create_future()
+        self._writer.write(encode({"id": self._next, "op": op, "args": args, "kwargs": kwargs}))
+        await self._writer.drain()
+        return _result(await future)
+
+    async def close(self):
+        self._writer.close()
+        await self._reading
+
+def use_server(address=ADDRESS):
+    """Send the game's user, market and squad calls to the server at `address`.
+
+    Replaces the functions listed in server.EXPOSED on those modules with
+    remote calls, so everything that looks them up at call time (which
+    is all of the game) goes through the server.  Returns the Client.
+    """
+    client = Client(address)
+    modules = {"user_system": user_system, "market": market, "squad_builder": squad_builder,
+               "pack_opening": pack_opening}
+    for module, names in EXPOSED.items():
+        for name in names:
+            setattr(modules[module], name, client.function(f"{module}.{name}"))
+    return client
@@ -1,57 +1,182 @@
-import json, os
-MARKET_FILE = "data/market.json"
+import json, time
+from modules import storage
+from modules.storage import card_columns, transaction
+
+SORT_KEYS = ("price", "rating")
+PAGE_SIZE = 20
+RETRIES = 5  # attempts when a listing changes between reading and writing it
+
+class Conflict(Exception):
+    """The listing changed since it was read (its version moved on)."""
+
+class _NotEnough(Exception):
+    # rolls the transaction back, the listing update included
+    pass
+
+def _listing(row):
+    return {"id": row["id"], "owner": row["owner"], "card": json.loads(row["card"]), "price": row["price"],
+            "bid": row["bid"], "bidder": row["bidder"], "version": row["version"], "expires": row["expires"]}
+
+def _row(item):
+    return (item.get("id"), item["owner"], json.dumps(item["card"]), item["price"], item.get("bid"),
+            item.get("bidder"), item.get("expires")) + card_columns(item["card"])
+
+INSERT = ("INSERT INTO market (id, owner, card, price, bid, bidder, expires, position, tier, rating) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
 
 def load_market():
-    if not os.path.exists(MARKET_FILE):
-        return []
-    with open(MARKET_FILE,"r") as f:
-        return json.load(f)
+    # a plain read: one statement sees one snapshot, no write lock needed
+    return [_listing(row) for row in storage.connect().execute("SELECT * FROM market ORDER BY id").fetchall()]
 
 def save_market(market):
-    with open(MARKET_FILE,"w") as f:
-        json.dump(market,f,indent=4)
+    with transaction() as db:
+        db.execute("DELETE FROM market")
+        db.executemany(INSERT, [_row(item) for item in market])
+
+def list_card(username, card, price, duration=None):
+    """Put `card` on the market; returns the listing's id, which never changes.
+
+    With a `duration` (seconds) it is also an auction: bids are taken
+    until then and settle_auctions() sells it to the highest bidder."""
+    if price <= 0:
+        raise ValueError(f"a card can't be listed for {price!r} coins")  # spend_coins won't take it
+    expires = time.time() + duration if duration else None
+    with transaction() as db:
+        return db.execute(INSERT, _row({"owner": username, "card": card, "price": price,
+                                        "expires": expires})).lastrowid
+
+def get_listing(listing_id):
+    row = storage.connect().execute("SELECT * FROM market WHERE id = ?", (listing_id,)).fetchone()
+    return _listing(row) if row else None
 
-def list_card(username, card, price):
-    market = load_market()
-    market.append({"owner":username,"card":card,"price":price,"bid":None})
-    save_market(market)
+def query(position=None, tier=None, min_rating=None, max_rating=None, min_price=None, max_price=None,
+          sort="price", descending=False, limit=PAGE_SIZE, after=None):
+    """One page of listings matching the filters, as (listings, cursor).
 
-def buy_card(buyer,index):
+    Sorted by `sort` ("price" or "rating"), ties by id.  Pass the returned
+    cursor back as `after` for the next page; it is None on the last one.
+    Each page is a range scan on one of the market indexes, so it costs
+    the same however deep into the results it is.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {SORT_KEYS}")
+    where, args = [], []
+    for column, op, value in (("position", "=", position), ("tier", "=", tier),
+                              ("rating", ">=", min_rating), ("rating", "<=", max_rating),
+                              ("price", ">=", min_price), ("price", "<=", max_price)):
+        if value is not None:
+            where.append(f"{column} {op} ?")
+            args.append(value)
+    if after is not None:
+        where.append(f"({sort}, id) {'<' if descending else '>'} (?, ?)")
+        args.extend(after)
+    order = "DESC" if descending else "ASC"
+    sql = (f"SELECT * FROM market {'WHERE ' + ' AND '.join(where) if where else ''} "
+           f"ORDER BY {sort} {order}, id {order} LIMIT ?")
+    rows = storage.connect().execute(sql, args + [limit + 1]).fetchall()
+    listings = [_listing(row) for row in rows[:limit]]
+    cursor = (rows[limit - 1][sort], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return listings, cursor
+
+def _refund_bids(db, where, args):
+    """Give the escrowed coins of the bids matching `where` back and drop them."""
+    db.execute(f"""UPDATE users SET coins = coins + (
+                       SELECT SUM(amount) FROM bids WHERE bidder = users.username AND {where})
+                   WHERE username IN (SELECT bidder FROM bids WHERE {where})""", args + args)
+    db.execute(f"DELETE FROM bids WHERE {where}", args)
+
+def _optimistic(attempt, listing_id, version):
+    """Run attempt(item, version) against a fresh read of the listing.
+
+    The read takes no lock; the attempt's writes are conditional on the
+    listing still having that version and raise Conflict otherwise.  With
+    no `version` given the whole thing is retried on a fresh read, with
+    one the caller's view is stale and the conflict is reported.
+    """
+    for _ in range(RETRIES if version is None else 1):
+        item = get_listing(listing_id)
+        if item is None:
+            return False,"No such listing"
+        try:
+            return attempt(item, item["version"] if version is None else version)
+        except Conflict:
+            continue
+    return False,"Listing changed, try again"
+
+def _cas(db, sql, args, listing_id, version):
+    # compare-and-swap: only touches the listing if nobody changed it since it was read
+    if db.execute(f"{sql} WHERE id = ? AND version = ?", args + (listing_id, version)).rowcount != 1:
+        raise Conflict(listing_id)
+
+def buy_card(buyer, listing_id, version=None):
     from modules.user_system import spend_coins, add_coins
-    market = load_market()
-    if index>=len(market):
-        return False,"Invalid index"
-    item = market[index]
-    if item["owner"]==buyer:
-        return False,"Cannot buy your own card"
-    price = item["price"]
-    if spend_coins(buyer, price):
-        add_coins(item["owner"], price)
-        del market[index]
-        save_market(market)
+    def attempt(item, version):
+        if item["owner"]==buyer:
+            return False,"Cannot buy your own card"
+        if item["bidder"] and item["expires"] is not None and item["expires"] <= time.time():
+            return False,"Auction has ended"
+        # one transaction: the buyer pays, the seller is paid, bids are
+        # refunded and the listing goes, or (on any error) none of it happens
+        with transaction() as db:
+            _cas(db, "DELETE FROM market", (), listing_id, version)
+            if not spend_coins(buyer, item["price"]):
+                raise _NotEnough
+            add_coins(item["owner"], item["price"])
+            _refund_bids(db, "listing_id = ?", (listing_id,))
         return True,"Card purchased successfully!"
-    return False,"Not enough coins"
-
-def bid_card(bidder,index,amount):
-    from modules.user_system import load_users, save_users
-    users = load_users()
-    market = load_market()
-    if index>=len(market):
-        return False,"Invalid index"
-    item = market[index]
-    if item["owner"]==bidder:
-        return False,"Cannot bid on your own card"
-    current_bid = item.get("bid",0)
-    if amount<=current_bid:
-        return False,"Bid must be higher than current bid"
-    if users[bidder]["coins"]<amount:
+    try:
+        return _optimistic(attempt, listing_id, version)
+    except _NotEnough:
         return False,"Not enough coins"
-    # Refund previous bidder
-    if item.get("bidder"):
-        users[item["bidder"]]["coins"] += item["bid"]
-    users[bidder]["coins"] -= amount
-    save_users(users)
-    item["bid"] = amount
-    item["bidder"] = bidder
-    save_market(market)
-    return True,"Bid placed"
+
+def bid_card(bidder, listing_id, amount, version=None):
+    """Bid on a listing.  On an auction the coins are held in escrow until
+    it is settled (or the card is bought outright), outbid or not; on a
+    fixed-price listing the bid it replaces is refunded straight away."""
+    from modules.user_system import spend_coins
+    def attempt(item, version):
+        if item["owner"]==bidder:
+            return False,"Cannot bid on your own card"
+        if item["expires"] is not None and item["expires"] <= time.time():
+            return False,"Auction has ended"
+        if amount<=(item["bid"] or 0):
+            return False,"Bid must be higher than current bid"
+        with transaction() as db:
+            _cas(db, "UPDATE market SET bid = ?, bidder = ?, version = version + 1", (amount, bidder),
+                 listing_id, version)
+            if not spend_coins(bidder, amount):
+                raise _NotEnough
+            if item["expires"] is None:
+                # nothing will settle it, so only the standing bid stays held
+                _refund_bids(db, "listing_id = ?", (listing_id,))
+            db.execute("INSERT INTO bids (listing_id, bidder, amount) VALUES (?, ?, ?)", (listing_id, bidder, amount))
+        return True,"Bid placed"
+    try:
+        return _optimistic(attempt, listing_id, version)
+    except _NotEnough:
+        return False,"Not enough coins"
+
+def settle_auctions(now=None):
+    """Close every auction that has ended, in one transaction.
+
+    Sellers are paid the winning bids, every other escrowed bid on those
+    listings goes back to its bidder and the sold listings are removed.
+    Auctions that ended without a bid stay on the market at their
+    buy-now price.  Returns how many cards were sold.
+    """
+    now = time.time() if now is None else now
+    with transaction() as db:
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS closing (id INTEGER PRIMARY KEY, owner TEXT, bid INTEGER, bidder TEXT)")
+        db.execute("DELETE FROM closing")
+        sold = db.execute("INSERT INTO closing SELECT id, owner, bid, bidder FROM market "
+                          "WHERE expires <= ? AND bidder IS NOT NULL", (now,)).rowcount
+        if sold:
+            db.execute("""UPDATE users SET coins = coins + (SELECT SUM(bid) FROM closing WHERE owner = users.username)
+                          WHERE username IN (SELECT owner FROM closing)""")
+            # the winning bid is the highest one, and became the seller's above
+            db.execute("""DELETE FROM bids WHERE id IN (
+                              SELECT MAX(b.id) FROM bids b JOIN closing c ON b.listing_id = c.id GROUP BY b.listing_id)""")
+            _refund_bids(db, "listing_id IN (SELECT id FROM closing)", ())
+            db.execute("DELETE FROM market WHERE id IN (SELECT id FROM closing)")
+        db.execute("UPDATE market SET expires = NULL, version = version + 1 WHERE expires <= ?", (now,))
+    return sold
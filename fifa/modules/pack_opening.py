@@ -11,17 +11,31 @@ def load_players():
             p["surface"] = None
     return players
 
+PACK_SIZE, PACK_PRICE = 5, 200
+
 try:
     OPEN_SOUND = pygame.mixer.Sound("assets/pack_open.wav")
 except:
     OPEN_SOUND = None
 
-def buy_pack(username, WIN, pack_size=5, pack_price=200):
-    from modules.user_system import spend_coins, add_coins
-    if not spend_coins(username, pack_price):
+def open_pack(username):
+    """Pay for a pack and draw its players, as (True, players) or (False, message).
+
+    The draw is plain players.json entries, no surfaces, so the server
+    can make it."""
+    from modules.user_system import spend_coins
+    if not spend_coins(username, PACK_PRICE):
         return False,"Not enough coins!"
-    players = load_players()
-    selected = random.sample(players, pack_size)
+    with open("data/players.json","r") as f:
+        return True, random.sample(json.load(f), PACK_SIZE)
+
+def buy_pack(username, WIN):
+    success, selected = open_pack(username)
+    if not success:
+        return False, selected
+    surfaces = {p["name"]: p["surface"] for p in load_players()}
+    for p in selected:
+        p["surface"] = surfaces.get(p["name"])
     
     if OPEN_SOUND:
         OPEN_SOUND.play()
@@ -0,0 +1,176 @@
+"""Market server: one process owns the fifa users, market and squads.
+
+    python -m modules.server [--host 127.0.0.1] [--port 5055] [--db data/fut.db]
+
+(run from the fifa folder, like main.py; `python main.py --server` then
+plays through it).  The protocol is one JSON object per line each way:
+
+    {"id": 1, "op": "market.buy_card", "args": ["bob", 7]}
+    {"id": 1, "result": [true, "Card purchased successfully!"]}
+
+or {"id": 1, "error": "ValueError: ..."} when the call raised.  Replies
+carry the request's id, so a client may send several before reading.
+Operations on a user's coins, cards and squad are only for the user the
+connection has logged in (or registered) as.  modules.client wraps all
+of this.
+"""
+import argparse, asyncio, json
+from concurrent.futures import ThreadPoolExecutor
+from modules import market, pack_opening, squad_builder, storage, user_system
+
+ADDRESS = ("127.0.0.1", 5055)
+LINE_LIMIT = 1 << 20  # longest request or reply, in bytes
+SETTLE_EVERY = 1.0  # seconds between settle_auctions() runs
+
+# what clients may call, by module.  Not add_coins or spend_coins (coins
+# for nothing, or out of anyone's balance) or settle_auctions (its `now`
+# could end every auction early): the server settles auctions itself.
+EXPOSED = {
+    "user_system": ("register", "login", "get_user", "get_coins"),
+    "market": ("load_market", "list_card", "get_listing", "query", "buy_card", "bid_card"),
+    "squad_builder": ("load_squad", "save_squad", "quick_sell"),
+    "pack_opening": ("open_pack",),
+}
+_MODULES = {"user_system": user_system, "market": market, "squad_builder": squad_builder,
+            "pack_opening": pack_opening}
+OPS = {f"{module}.{name}": getattr(_MODULES[module], name) for module, names in EXPOSED.items() for name in names}
+# the operations whose first argument is the user they act for
+AS_USER = {"user_system.get_user", "user_system.get_coins", "market.list_card", "market.buy_card",
+           "market.bid_card", "squad_builder.load_squad", "squad_builder.save_squad",
+           "squad_builder.quick_sell", "pack_opening.open_pack"}
+SIGN_IN = {"user_system.register", "user_system.login"}
+
+def encode(message):
+    # cards carry the UI's pygame surfaces and rects; they don't travel
+    return json.dumps(message, default=lambda value: None).encode() + b"\n"
+
+def _run(batch):
+    replies = []
+    for function, args, kwargs in batch:
+        try:
+            replies.append({"result": function(*args, **kwargs)})
+        except Exception as e:
+            replies.append({"error": f"{type(e).__name__}: {e}"})
+    return replies
+
+class Session:
+    """The user one connection is logged in as.
+
+    Its requests run on the worker in the order they were sent, so a
+    login counts for the requests right behind it, before its reply is
+    back.
+    """
+
+    def __init__(self):
+        self.user = None
+
+    def run(self, op, args, kwargs):
+        if op in AS_USER and (self.user is None or not args or args[0] != self.user):
+            raise PermissionError(f"{op} takes the logged-in user as its first argument")
+        result = OPS[op](*args, **kwargs)
+        if op in SIGN_IN and result[0]:
+            self.user = args[0] if args else kwargs.get("username")
+        return result
+
+class Server:
+    """Runs every request on one worker thread, in arrival order.
+
+    Being the only writer, the worker never waits on SQLite's locks and
+    the user cache stays valid between requests.  Requests that arrive
+    while it is busy are handed over together as the next batch, so a
+    burst costs one thread switch rather than one per request.
+    """
+
+    def __init__(self):
+        self._worker = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        self._draining = False
+        self.requests = 0
+
+    def call(self, function, args=(), kwargs=None):
+        """A future for the reply to one call of `function`."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((function, args, kwargs or {}, future))
+        if not self._draining:
+            self._draining = True
+            asyncio.ensure_future(self._drain())
+        return future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                replies = await loop.run_in_executor(self._worker, _run, [item[:3] for item in batch])
+                self.requests += len(batch)
+                for item, reply in zip(batch, replies):
+                    if not item[3].cancelled():
+                        item[3].set_result(reply)
+        finally:
+            self._draining = False
+
+    async def settle_forever(self):
+        while True:
+            await asyncio.sleep(SETTLE_EVERY)
+            await self.call(market.settle_auctions)
+
+    async def handle(self, reader, writer):
+        session = Session()
+        def reply(request_id, future):
+            if not writer.is_closing():
+                writer.write(encode(dict(future.result(), id=request_id)))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    op = request["op"]
+                    if op not in OPS:
+                        raise ValueError(f"unknown operation {op!r}")
+                    future = self.call(session.run, (op, request.get("args", ()), request.get("kwargs") or {}))
+                except (ValueError, KeyError, AttributeError) as e:
+                    writer.write(encode({"id": request_id, "error": f"bad request: {e}"}))
+                    continue
+                future.add_done_callback(lambda future, request_id=request_id: reply(request_id, future))
+                # stop reading while the client isn't taking its replies
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass  # hung up, or sent a line over LINE_LIMIT
+        finally:
+            writer.close()
+
+    def close(self):
+        self._worker.shutdown()
+        user_system.flush()
+
+async def serve(host, port):
+    server = Server()
+    listener = await asyncio.start_server(server.handle, host, port, limit=LINE_LIMIT, backlog=4096)
+    host, port = listener.sockets[0].getsockname()[:2]
+    print(f"serving on {host}:{port}", flush=True)
+    settle = asyncio.ensure_future(server.settle_forever())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        settle.cancel()
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=ADDRESS[0])
+    parser.add_argument("--port", type=int, default=ADDRESS[1], help="0 picks a free port")
+    parser.add_argument("--db", default=storage.DB_FILE, help="database file")
+    args = parser.parse_args()
+    storage.DB_FILE = args.db
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
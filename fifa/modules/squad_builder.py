@@ -1,10 +1,10 @@
 import pygame, os, json
-from modules import user_system
+from modules import storage, user_system
+from modules.storage import transaction
 
 CARD_WIDTH, CARD_HEIGHT = 100,150
 PLAYER_SPACING = 10
 
-SQUADS_FILE = "data/squads.json"
 PLAYERS_FILE = "data/players.json"
 
 FORMATION_POSITIONS = [
@@ -14,7 +14,7 @@ FORMATION_POSITIONS = [
     "ST1", "ST2"
 ]
 
-# --- JSON load/save ---
+# --- Load/save ---
 def load_players():
     if not os.path.exists(PLAYERS_FILE):
         return []
@@ -24,46 +24,42 @@ def load_players():
         except json.JSONDecodeError:
             return []
 
+def _plain(player):
+    # drop what the UI hangs on a player (surfaces, rects) before storing it
+    if isinstance(player, dict):
+        return {k: v for k, v in player.items() if k not in ("surface", "rect", "sell_rect")}
+    return player
+
 def load_squad(username):
-    if not os.path.exists(SQUADS_FILE) or os.path.getsize(SQUADS_FILE)==0:
-        with open(SQUADS_FILE,"w") as f:
-            json.dump({},f)
-        return {}
-    with open(SQUADS_FILE,"r") as f:
-        try:
-            squads = json.load(f)
-        except json.JSONDecodeError:
-            squads = {}
-    return squads.get(username, {})
+    row = storage.connect().execute("SELECT squad FROM squads WHERE username = ?", (username,)).fetchone()
+    return json.loads(row["squad"]) if row else {}
 
 def save_squad(username, squad):
-    if not os.path.exists(SQUADS_FILE) or os.path.getsize(SQUADS_FILE)==0:
-        squads = {}
-    else:
-        with open(SQUADS_FILE,"r") as f:
-            try:
-                squads = json.load(f)
-            except json.JSONDecodeError:
-                squads = {}
-    squads[username] = squad
-    with open(SQUADS_FILE,"w") as f:
-        json.dump(squads,f, indent=4)
+    squad = {k: [_plain(p) for p in v] if isinstance(v, list) else _plain(v) for k, v in squad.items()}
+    with transaction() as db:
+        db.execute("INSERT INTO squads (username, squad) VALUES (?, ?) "
+                   "ON CONFLICT (username) DO UPDATE SET squad = excluded.squad",
+                   (username, json.dumps(squad)))
 
 # --- Quick Sell ---
 def quick_sell(username, player):
-    coin_value = player.get("rating",50)*10
-    users = user_system.load_users()
-    users[username]["coins"] += coin_value
-    user_system.save_users(users)
-
-    # Remove from squad if exists
-    squad = load_squad(username)
-    for k,v in squad.items():
-        if isinstance(v, list):
-            squad[k] = [p for p in v if p!=player]
-        elif v==player:
-            squad[k]=None
-    save_squad(username, squad)
+    # priced from players.json: over the server `player` is whatever the client sent
+    known = next((p for p in load_players() if p.get("name") == player.get("name")), None)
+    if known is None:
+        raise ValueError(f"unknown player {player.get('name')!r}")
+    coin_value = known.get("rating",50)*10
+    player = _plain(player)
+    with transaction():
+        user_system.add_coins(username, coin_value)
+
+        # Remove from squad if exists
+        squad = load_squad(username)
+        for k,v in squad.items():
+            if isinstance(v, list):
+                squad[k] = [p for p in v if p!=player]
+            elif v==player:
+                squad[k]=None
+        save_squad(username, squad)
 
 # --- Squad Builder UI ---
 def squad_builder_ui(WIN, username):
@@ -100,8 +96,7 @@ def squad_builder_ui(WIN, username):
         WIN.blit(BIG_FONT.render("Squad Builder",True,(0,0,0)),(WIN.get_width()//2-80,10))
 
         # Coin display
-        users = user_system.load_users()
-        coins = users.get(username,{}).get("coins",0)
+        coins = user_system.get_coins(username)
         WIN.blit(FONT.render(f"Coins: {coins}",True,(0,0,0)),(WIN.get_width()-150,20))
 
         # --- Player List ---
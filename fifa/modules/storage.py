@@ -0,0 +1,197 @@
+import json, os, sqlite3, threading
+from contextlib import contextmanager
+
+# Users, market listings and squads live in one SQLite file, so a purchase
+# is one indexed transaction instead of rewriting whole JSON files, and a
+# crash can't leave coins half-transferred.  The old data/*.json files are
+# imported once, when the database is created.
+
+DB_FILE = "data/fut.db"
+JSON_FILES = {"users": "data/users.json", "market": "data/market.json", "squads": "data/squads.json"}
+
+SCHEMA_VERSION = 5
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        coins INTEGER NOT NULL CHECK (coins >= 0),
+        squad TEXT NOT NULL DEFAULT '[]'
+    )""",
+    """CREATE TABLE IF NOT EXISTS market (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner TEXT NOT NULL,
+        card TEXT NOT NULL,
+        price INTEGER NOT NULL,
+        bid INTEGER,
+        bidder TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS market_owner ON market (owner)",
+    """CREATE TABLE IF NOT EXISTS squads (
+        username TEXT PRIMARY KEY,
+        squad TEXT NOT NULL
+    )""",
+]
+# version 2: card fields copied into columns, with indexes for market.query()
+MARKET_COLUMNS = ("position", "tier", "rating")
+MARKET_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS market_price ON market (price, id)",
+    "CREATE INDEX IF NOT EXISTS market_rating ON market (rating, id)",
+    "CREATE INDEX IF NOT EXISTS market_position_price ON market (position, price, id)",
+    "CREATE INDEX IF NOT EXISTS market_position_rating ON market (position, rating, id)",
+    "CREATE INDEX IF NOT EXISTS market_tier_price ON market (tier, price, id)",
+    "CREATE INDEX IF NOT EXISTS market_tier_rating ON market (tier, rating, id)",
+]
+
+# version 3: listing versions for compare-and-swap, auction end times and
+# the bids table, which holds every bid's coins in escrow until settlement
+AUCTION_SCHEMA = [
+    "ALTER TABLE market ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE market ADD COLUMN expires REAL",
+    "CREATE INDEX IF NOT EXISTS market_expires ON market (expires)",
+    """CREATE TABLE IF NOT EXISTS bids (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        listing_id INTEGER NOT NULL,
+        bidder TEXT NOT NULL,
+        amount INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS bids_listing ON bids (listing_id)",
+    # the standing bid of listings from before version 3 was already paid for
+    "INSERT INTO bids (listing_id, bidder, amount) SELECT id, bidder, bid FROM market WHERE bidder IS NOT NULL",
+]
+
+# version 4: user_changes logs which users each commit touched, whoever
+# made it, so the user cache can read just those again
+_LOG_CHANGE = ("INSERT OR REPLACE INTO user_changes (username, seq) "
+               "VALUES ({}.username, (SELECT COALESCE(MAX(seq), 0) + 1 FROM user_changes))")
+CHANGES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS user_changes (username TEXT PRIMARY KEY, seq INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS user_changes_seq ON user_changes (seq)",
+    f"CREATE TRIGGER IF NOT EXISTS users_inserted AFTER INSERT ON users BEGIN {_LOG_CHANGE.format('new')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS users_updated AFTER UPDATE ON users BEGIN {_LOG_CHANGE.format('new')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS users_deleted AFTER DELETE ON users BEGIN {_LOG_CHANGE.format('old')}; END",
+]
+
+def card_columns(card):
+    """(position, tier, rating) of a card, as stored next to its listing.
+
+    A card without a rating is stored as 0, not NULL: query() pages with
+    (rating, id) comparisons, and those are NULL against a NULL rating."""
+    rating = card.get("rating")
+    return card.get("position"), card.get("tier"), 0 if rating is None else rating
+
+_local = threading.local()
+
+def _read_json(path, default):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return default
+    with open(path, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return default
+
+def _import_json(db):
+    users = _read_json(JSON_FILES["users"], {})
+    db.executemany("INSERT INTO users (username, password, coins, squad) VALUES (?, ?, ?, ?)",
+                   [(name, u.get("password", ""), u.get("coins", 0), json.dumps(u.get("squad", [])))
+                    for name, u in users.items()])
+    # (the version 1 table; version 2 fills in the card columns after this)
+    market = _read_json(JSON_FILES["market"], [])
+    db.executemany("INSERT INTO market (owner, card, price, bid, bidder) VALUES (?, ?, ?, ?, ?)",
+                   [(item["owner"], json.dumps(item["card"]), item["price"], item.get("bid"), item.get("bidder"))
+                    for item in market])
+    squads = _read_json(JSON_FILES["squads"], {})
+    db.executemany("INSERT INTO squads (username, squad) VALUES (?, ?)",
+                   [(name, json.dumps(squad)) for name, squad in squads.items()])
+
+def _migrate(db):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        for statement in SCHEMA:
+            db.execute(statement)
+        _import_json(db)
+    if version < 2:
+        db.execute("ALTER TABLE market ADD COLUMN position TEXT")
+        db.execute("ALTER TABLE market ADD COLUMN tier TEXT")
+        db.execute("ALTER TABLE market ADD COLUMN rating INTEGER")
+        rows = db.execute("SELECT id, card FROM market").fetchall()
+        db.executemany("UPDATE market SET position = ?, tier = ?, rating = ? WHERE id = ?",
+                       [card_columns(json.loads(row["card"])) + (row["id"],) for row in rows])
+        for statement in MARKET_INDEXES:
+            db.execute(statement)
+    if version < 3:
+        for statement in AUCTION_SCHEMA:
+            db.execute(statement)
+    if version < 4:
+        for statement in CHANGES_SCHEMA:
+            db.execute(statement)
+    if version < 5:
+        db.execute("UPDATE market SET rating = 0 WHERE rating IS NULL")
+    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def open_connection(check_same_thread=True):
+    """A new connection in autocommit mode (transaction() issues BEGIN/COMMIT)."""
+    db = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None, check_same_thread=check_same_thread)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+def connect():
+    """This thread's connection, opened (and the schema set up) on first use."""
+    db = getattr(_local, "db", None)
+    if db is None:
+        db = open_connection()
+        _local.db = db
+        _local.depth = 0
+        with transaction():
+            if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                _migrate(db)
+    return db
+
+def close():
+    db = getattr(_local, "db", None)
+    if db is not None:
+        db.close()
+        _local.db = None
+
+def in_transaction():
+    return bool(getattr(_local, "depth", 0))
+
+@contextmanager
+def transaction(on_end=None):
+    """`with transaction() as db:` runs the block as one atomic transaction.
+
+    Nested uses join the outermost one, so helpers like add_coins can be
+    combined into a single purchase.  on_end(committed) is called once
+    the outermost transaction has committed or rolled back (or failed to
+    start)."""
+    db = connect()
+    if _local.depth:
+        if on_end:
+            _local.on_end.append(on_end)
+        _local.depth += 1
+        try:
+            yield db
+        finally:
+            _local.depth -= 1
+        return
+    _local.on_end = [on_end] if on_end else []
+    committed = False
+    try:
+        # IMMEDIATE takes the write lock up front, so two processes can't
+        # both read a balance and then both spend it
+        db.execute("BEGIN IMMEDIATE")
+        _local.depth = 1
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        committed = True
+    finally:
+        _local.depth = 0
+        callbacks, _local.on_end = _local.on_end, []
+        for callback in callbacks:
+            callback(committed)
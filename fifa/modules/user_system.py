@@ -1,44 +1,180 @@
-import json, os
+import atexit, json, sqlite3, threading, time
+from modules import storage
+from modules.storage import transaction
 
-USERS_FILE = "data/users.json"
+FLUSH_AFTER = 1.0  # seconds a credit may wait in memory before it is written
+
+def _user(row):
+    return {"password": row["password"], "coins": row["coins"], "squad": json.loads(row["squad"])}
+
+def _public(user):
+    # what get_user and login hand out: everything but the password
+    return {k: v for k, v in user.items() if k != "password"}
+
+class UserCache:
+    """All users, kept in memory.
+
+    The menus read the coin balance every frame, so reads come from here.
+    PRAGMA data_version on the cache's own connection changes whenever
+    any other connection (another process, or a transaction in this one)
+    commits; the users that commit touched are then read again, found
+    through the user_changes log the database keeps.  Credits made
+    outside a transaction are applied here and queued as dirty; flush()
+    writes the queue as deltas in one transaction, at most FLUSH_AFTER
+    seconds later and at exit.  Only credits are queued: adding coins
+    can't fail, so a flush can't either, while a debit has to be checked
+    against the balance in the database (another process may be spending
+    the same coins) and is written straight away by spend_coins.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()  # never held while waiting for the database's write lock
+        self._db = None
+        self._version = None
+        self._users = None
+        self._seq = 0  # last user_changes entry read
+        self._stale = set()  # users to read again whatever the log says
+        self._dirty = {}  # username -> coin delta not written yet
+        self._flushing = {}  # deltas being written right now
+        self._dirty_since = None
+
+    def _fresh(self):
+        if self._db is None:
+            storage.connect()  # sets up the schema
+            self._db = storage.open_connection(check_same_thread=False)
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if self._users is None:
+            # (log first: a change between the two reads is just read again)
+            self._seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+            self._users = {row["username"]: _user(row) for row in self._db.execute("SELECT * FROM users")}
+            self._stale = set()
+            self._apply_pending(self._users)
+        elif version != self._version or self._stale:
+            changes = self._db.execute("SELECT username, seq FROM user_changes WHERE seq > ?", (self._seq,)).fetchall()
+            names, self._stale = self._stale | {row["username"] for row in changes}, set()
+            self._seq = max([self._seq] + [row["seq"] for row in changes])
+            for name in names:
+                self._users.pop(name, None)
+            self._users.update((row["username"], _user(row)) for row in self._db.execute(
+                "SELECT * FROM users WHERE username IN (SELECT value FROM json_each(?))", (json.dumps(list(names)),)))
+            self._apply_pending(names)
+        self._version = version
+        return self._users
+
+    def _apply_pending(self, names):
+        for pending in (self._flushing, self._dirty):
+            for name, delta in pending.items():
+                if name in names and name in self._users:
+                    self._users[name]["coins"] += delta
+
+    def _flush_if_due(self):
+        if self._dirty_since is not None and time.monotonic() - self._dirty_since > FLUSH_AFTER:
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # the users are read again on the next access
+
+    def get(self, username):
+        self._flush_if_due()
+        with self._lock:
+            user = self._fresh().get(username)
+            return dict(user) if user else None
+
+    def all(self):
+        self._flush_if_due()
+        with self._lock:
+            return {name: dict(u) for name, u in self._fresh().items()}
+
+    def credit(self, username, amount):
+        """Add `amount` coins now, and queue it for the database."""
+        with self._lock:
+            user = self._fresh().get(username)
+            if user is None:
+                return
+            user["coins"] += amount
+            self._dirty[username] = self._dirty.get(username, 0) + amount
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+
+    def flush(self):
+        """Write the queued credits in one transaction.
+
+        Inside a transaction they join it, and only count as written once
+        it commits."""
+        with self._lock:
+            if not self._dirty or self._flushing:
+                return
+            self._flushing, self._dirty, self._dirty_since = self._dirty, {}, None
+        with transaction(on_end=self._flushed) as db:
+            db.executemany("UPDATE users SET coins = coins + ? WHERE username = ?",
+                           [(delta, name) for name, delta in self._flushing.items()])
+
+    def _flushed(self, committed):
+        with self._lock:
+            if not committed:
+                # busy, or the purchase this was part of failed: keep the
+                # credits for the next flush
+                for name, delta in self._flushing.items():
+                    self._dirty[name] = self._dirty.get(name, 0) + delta
+                self._dirty_since = self._dirty_since or time.monotonic()
+            self._stale.update(self._flushing)
+            self._flushing = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._users = None
+
+_cache = UserCache()
+atexit.register(_cache.flush)
+
+def flush():
+    _cache.flush()
 
 def load_users():
-    if not os.path.exists(USERS_FILE) or os.path.getsize(USERS_FILE) == 0:
-        # Ha nem létezik vagy üres, hozzunk létre egy üres dict-et
-        with open(USERS_FILE, "w") as f:
-            json.dump({}, f)
-        return {}
-    with open(USERS_FILE, "r") as f:
-        return json.load(f)
+    return _cache.all()
 
 def save_users(users):
-    with open(USERS_FILE,"w") as f:
-        json.dump(users,f,indent=4)
+    _cache.flush()
+    with transaction() as db:
+        db.executemany("INSERT INTO users (username, password, coins, squad) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT (username) DO UPDATE SET "
+                       "password = excluded.password, coins = excluded.coins, squad = excluded.squad",
+                       [(name, u.get("password", ""), u.get("coins", 0), json.dumps(u.get("squad", [])))
+                        for name, u in users.items()])
+
+def get_user(username):
+    user = _cache.get(username)
+    return _public(user) if user else None
+
+def get_coins(username):
+    user = _cache.get(username)
+    return user["coins"] if user else 0
 
 def register(username,password):
-    users = load_users()
-    if username in users:
-        return False,"Username already exists!"
-    users[username] = {"password":password,"coins":1000,"squad":[]}
-    save_users(users)
+    with transaction() as db:
+        if db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+            return False,"Username already exists!"
+        db.execute("INSERT INTO users (username, password, coins) VALUES (?, ?, 1000)", (username, password))
     return True,"Registration successful!"
 
 def login(username,password):
-    users = load_users()
-    if username in users and users[username]["password"]==password:
-        return True, users[username]
+    user = _cache.get(username)
+    if user and user["password"]==password:
+        return True, _public(user)
     return False, None
 
 def add_coins(username,amount):
-    users = load_users()
-    if username in users:
-        users[username]["coins"] += amount
-        save_users(users)
+    if not storage.in_transaction():
+        _cache.credit(username, amount)
+        return
+    storage.connect().execute("UPDATE users SET coins = coins + ? WHERE username = ?", (amount, username))
 
 def spend_coins(username,amount):
-    users = load_users()
-    if username in users and users[username]["coins"] >= amount:
-        users[username]["coins"] -= amount
-        save_users(users)
-        return True
-    return False
+    # written through, and only if the database balance covers it
+    if amount <= 0:
+        raise ValueError(f"can't spend {amount!r} coins")
+    with transaction() as db:
+        _cache.flush()  # joins the transaction, so queued credits count
+        cur = db.execute("UPDATE users SET coins = coins - ? WHERE username = ? AND coins >= ?",
+                         (amount, username, amount))
+    return cur.rowcount == 1
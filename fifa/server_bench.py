@@ -0,0 +1,140 @@
+"""Load test for the market server: thousands of simulated clients on localhost.
+
+    python server_bench.py --clients 2000 --seconds 10
+    python server_bench.py --address :5055 --clients 500 --out server_bench.json
+
+Starts a server on a scratch database (unless --address points at one
+that is running), opens one connection per simulated client and has
+each of them play back to back: check coins, page through the market,
+list cards, bid and buy.  Prints requests/s and latency percentiles,
+overall and per operation, and writes them as JSON.
+"""
+import argparse, asyncio, json, os, platform, random, subprocess, sys, tempfile, time
+from modules.client import AsyncClient, RemoteError, parse_address
+
+PERCENTILES = (50, 90, 99, 99.9)
+# (share of requests, operation) for a simulated client's next move
+MIX = ((0.35, "get_coins"), (0.25, "query"), (0.10, "list_card"), (0.20, "bid_card"), (0.10, "buy_card"))
+POSITIONS = ("GK", "CB", "LB", "RB", "CM", "LM", "RM", "ST")
+TIERS = ("bronze", "silver", "gold")
+
+def start_server(db):
+    """A server subprocess on a free port, and its address."""
+    server = subprocess.Popen([sys.executable, "-m", "modules.server", "--port", "0", "--db", db],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True)
+    for line in server.stdout:  # (after pygame's greeting)
+        if line.startswith("serving on"):
+            return server, parse_address(line.split()[-1])
+    server.wait()
+    raise RuntimeError("the server didn't start")
+
+async def simulate(client, name, rng, deadline, latencies):
+    """One client's requests until `deadline`; latencies[op] collects seconds."""
+    listings = []
+    async def call(op, *args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return await client.call(op, *args, **kwargs)
+        finally:
+            latencies.setdefault(op.rpartition(".")[2], []).append(time.perf_counter() - t)
+    while time.perf_counter() < deadline:
+        r = rng.random()
+        for share, op in MIX:
+            r -= share
+            if r < 0:
+                break
+        if op in ("bid_card", "buy_card") and not listings:
+            op = "query"
+        if op == "get_coins":
+            await call("user_system.get_coins", name)
+        elif op == "query":
+            page, _ = await call("market.query", position=rng.choice(POSITIONS), sort=rng.choice(("price", "rating")),
+                                 min_price=rng.randrange(0, 1000, 50), limit=10)
+            listings = page or listings
+        elif op == "list_card":
+            card = {"name": f"Player {rng.randrange(1000)}", "position": rng.choice(POSITIONS),
+                    "tier": rng.choice(TIERS), "rating": rng.randint(50, 95)}
+            await call("market.list_card", name, card, rng.randint(100, 1000), rng.choice((None, 5, 30)))
+        elif op == "bid_card":
+            item = rng.choice(listings)
+            await call("market.bid_card", name, item["id"], (item["bid"] or 0) + rng.randint(1, 50))
+        else:
+            await call("market.buy_card", name, listings.pop(rng.randrange(len(listings)))["id"])
+
+def percentiles(seconds):
+    seconds = sorted(seconds)
+    out = {f"p{p:g}_ms": 1000 * seconds[min(len(seconds) - 1, int(len(seconds) * p / 100))] for p in PERCENTILES}
+    out["max_ms"] = 1000 * seconds[-1]
+    return out
+
+async def run(address, clients, seconds, seed):
+    rng = random.Random(seed)
+    t = time.perf_counter()
+    connections = await asyncio.gather(*[AsyncClient.connect(address) for _ in range(clients)])
+    connect_s = time.perf_counter() - t
+    names = [f"bench{i}" for i in range(clients)]
+    # registering twice just says the name is taken; the login is what
+    # lets each connection act for its user
+    await asyncio.gather(*[c.call("user_system.register", name, "") for c, name in zip(connections, names)])
+    await asyncio.gather(*[c.call("user_system.login", name, "") for c, name in zip(connections, names)])
+    latencies = {}
+    t = time.perf_counter()
+    results = await asyncio.gather(*[simulate(c, name, random.Random(rng.random()), t + seconds, latencies)
+                                     for c, name in zip(connections, names)], return_exceptions=True)
+    elapsed = time.perf_counter() - t
+    await asyncio.gather(*[c.close() for c in connections])
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise errors[0]
+    every = [s for op in latencies.values() for s in op]
+    return {"requests": len(every), "per_s": len(every) / elapsed, "connect_s": connect_s,
+            "latency": percentiles(every),
+            "ops": {op: dict(percentiles(s), requests=len(s)) for op, s in sorted(latencies.items())}}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000, help="simultaneous simulated clients")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--address", help="HOST:PORT of a running server (default: start one on a scratch database)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="server_bench.json")
+    args = parser.parse_args()
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # a socket per client, on both ends when the server runs here too
+        wanted = 2 * args.clients + 100
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass  # no resource module on Windows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        if args.address:
+            address = parse_address(args.address)
+        else:
+            server, address = start_server(os.path.join(tmp, "fut.db"))
+        try:
+            results = asyncio.run(run(address, args.clients, args.seconds, args.seed))
+        except RemoteError as e:
+            sys.exit(f"server error: {e}")
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+    results["meta"] = {
+        "python": sys.version.split()[0], "platform": platform.platform(), "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"), "clients": args.clients, "seconds": args.seconds,
+        "server": args.address or "scratch", "seed": args.seed,
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"{results['requests']} requests from {args.clients} clients: {results['per_s']:.0f}/s")
+    print("  ".join(f"{k[:-3]} {v:.2f} ms" for k, v in results["latency"].items()))
+    for op, stats in results["ops"].items():
+        print(f"  {op:12s} {stats['requests']:8d}  p50 {stats['p50_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms")
+
+if __name__ == "__main__":
+    main()
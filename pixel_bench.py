@@ -0,0 +1,194 @@
+"""Headless benchmarks for pixel-arranger's matching and motion engines.
+
+    python pixel_bench.py --out bench.json
+    python pixel_bench.py --out new.json --compare bench.json
+
+Measures image prep, index build, assignment throughput at several fill
+levels of the used-mask and the per-frame particle update/draw cost, and
+writes everything as JSON so runs from different versions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from pixel_engine import (ParticleStore, TargetMatcher, TiledMatcher, prepare_target,
+                          stamp_disks)
+
+FILL_LEVELS = (0.0, 0.5, 0.9, 0.99)
+PARTICLE_COUNTS = (10_000, 100_000, 1_000_000)
+
+
+def synthetic_image(path, size, seed=0):
+    """Write a photo-like test image: smooth gradients plus some noise."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:size, 0:size] / max(1, size - 1)
+    rgb = np.stack([
+        128 + 100 * np.sin(3 * xs + 2 * ys),
+        128 + 100 * np.cos(4 * ys - xs),
+        128 + 100 * np.sin(5 * xs * ys + 1),
+    ], axis=-1)
+    rgb += rng.normal(0, 12, rgb.shape)
+    Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(path)
+
+
+def timed(fn, *args, **kwargs):
+    t = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t
+
+
+def bench_prep(path, max_dim):
+    with tempfile.TemporaryDirectory() as cache:
+        _, cold = timed(prepare_target, path, max_dim, cache_dir=cache)
+        _, warm = timed(prepare_target, path, max_dim, cache_dir=cache)
+    _, nocache = timed(prepare_target, path, max_dim, cache_dir=None)
+    return {"cold_s": cold, "cached_s": warm, "uncached_s": nocache}
+
+
+def make(kind, tgt_col, cache):
+    if kind == "kdtree":
+        return TargetMatcher(tgt_col)
+    if kind.startswith("lut"):
+        return TargetMatcher(tgt_col, lut_bits=int(kind[3:]), cache_dir=cache)
+    if kind.startswith("tiles"):
+        return TiledMatcher(tgt_col, tiles=int(kind[5:]))
+    raise ValueError(kind)
+
+
+def fill(matcher, level, rng):
+    """Mark a random `level` fraction of the target pixels as used."""
+    n = len(matcher)
+    idx = rng.choice(n, int(level * n), replace=False)
+    if isinstance(matcher, TiledMatcher):
+        matcher.claim(idx)
+    else:
+        matcher._claim(idx)
+
+
+def bench_assign(kind, tgt_col, rng, strokes, brush=60):
+    """Target assignments per second, one brush-sized batch per stroke."""
+    out = {}
+    with tempfile.TemporaryDirectory() as cache:
+        for level in FILL_LEVELS:
+            matcher = make(kind, tgt_col, cache)
+            try:
+                fill(matcher, level, rng)
+                colors = rng.integers(0, 256, (strokes, 3))
+                # warm up (lazy rebuilds after the fill count as setup)
+                matcher.assign(np.tile(colors[0], (brush, 1)))
+                t = time.perf_counter()
+                for c in colors:
+                    matcher.assign(np.tile(c, (brush, 1)))
+                dt = time.perf_counter() - t
+            finally:
+                if isinstance(matcher, TiledMatcher):
+                    matcher.close()
+            out[f"{level:g}"] = {"per_s": strokes * brush / dt, "ms_per_stroke": 1000 * dt / strokes}
+    return out
+
+
+def bench_build(kind, tgt_col):
+    with tempfile.TemporaryDirectory() as cache:
+        matcher, cold = timed(make, kind, tgt_col, cache)
+        if isinstance(matcher, TiledMatcher):
+            matcher.close()
+            return {"cold_s": cold}
+        _, warm = timed(make, kind, tgt_col, cache)
+    return {"cold_s": cold, "cached_s": warm} if kind.startswith("lut") else {"cold_s": cold}
+
+
+def bench_particles(count, width, height, rng, frames=20):
+    """Per-frame motion update and moving-particle draw cost."""
+    tgt_pos = np.column_stack((rng.random(width * height) * width,
+                               rng.random(width * height) * height)).astype(np.float32)
+    store = ParticleStore()
+    # start far from the targets so nothing settles while timing
+    start = rng.random((count, 2)) * (width, height) + (4 * width, 4 * height)
+    store.add(start, rng.integers(0, len(tgt_pos), count), rng.integers(0, 256, (count, 3)))
+    canvas = np.zeros((width, height, 3), dtype=np.uint8)
+    update = draw = 0.0
+    for _ in range(frames):
+        _, dt = timed(store.update, tgt_pos)
+        update += dt
+        n = len(store)
+        _, dt = timed(stamp_disks, canvas, store.pos[:n], store.color[:n])
+        draw += dt
+    return {"update_ms": 1000 * update / frames, "draw_ms": 1000 * draw / frames,
+            "settled": store.settled_count}
+
+
+def compare(new, old, path=()):
+    """Print ratios for every numeric leaf present in both runs."""
+    for key, value in new.items():
+        if key == "meta" or key not in old:
+            continue
+        if isinstance(value, dict):
+            compare(value, old[key], path + (key,))
+        elif isinstance(value, (int, float)) and old[key]:
+            ratio = value / old[key]
+            print(f"{'/'.join(path + (key,)):50s} {old[key]:12.4g} -> {value:12.4g}  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", help="image to benchmark with (default: synthetic)")
+    parser.add_argument("--size", type=int, default=1024, help="synthetic image side length")
+    parser.add_argument("--max-dim", type=int, default=2048)
+    parser.add_argument("--strokes", type=int, default=200, help="strokes per fill level")
+    parser.add_argument("--matchers", default="kdtree,lut5",
+                        help="comma separated: kdtree, lutBITS, tilesN")
+    parser.add_argument("--particles", default=",".join(str(c) for c in PARTICLE_COUNTS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="pixel_bench.json")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="print ratios against an earlier run")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.image
+        if not path:
+            path = os.path.join(tmp, "bench.png")
+            synthetic_image(path, args.size, args.seed)
+        results = {"prep": bench_prep(path, args.max_dim)}
+        rgb, tgt_pos, tgt_col = prepare_target(path, args.max_dim, cache_dir=None)
+    height, width = rgb.shape[:2]
+    results["meta"] = {
+        "python": sys.version.split()[0], "numpy": np.__version__,
+        "platform": platform.platform(), "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "image": args.image or f"synthetic {args.size}x{args.size}",
+        "pixels": int(len(tgt_col)), "strokes": args.strokes, "seed": args.seed,
+    }
+
+    results["index_build"] = {}
+    results["assign"] = {}
+    for kind in args.matchers.split(","):
+        kind = kind.strip()
+        print(f"{kind}: build", flush=True)
+        results["index_build"][kind] = bench_build(kind, tgt_col)
+        print(f"{kind}: assign", flush=True)
+        results["assign"][kind] = bench_assign(kind, tgt_col, rng, args.strokes)
+
+    results["particles"] = {}
+    for count in args.particles.split(","):
+        count = int(count)
+        print(f"particles: {count}", flush=True)
+        results["particles"][str(count)] = bench_particles(count, width, height, rng)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,992 @@
+"""Engine pieces for pixel-arranger.py.
+
+Kept out of the script itself so they can be used without opening a window
+(the script pulls in pygame and tkinter at import time).
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import struct
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+from scipy.spatial import cKDTree
+
+# Prepared data (color lookup tables, ...) is cached here between runs
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pixel-arranger")
+
+
+def array_digest(arr):
+    """Short content hash of an array, used as a cache key."""
+    h = hashlib.sha1(str((arr.shape, arr.dtype.str)).encode())
+    h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()[:16]
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def load_image(path, max_dim=2048):
+    """Open an image as RGB, compositing alpha onto white.
+
+    Images larger than `max_dim` on their long side are downscaled slightly
+    for real-time performance.
+    """
+    img = Image.open(path)
+    if img.mode in ("RGBA", "LA") or ("transparency" in img.info):
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        try:
+            bg.paste(img, mask=img.split()[-1])
+            img = bg
+        except Exception:
+            img = img.convert("RGB")
+    else:
+        img = img.convert("RGB")
+    if max_dim and max(img.size) > max_dim:
+        scale = max_dim / max(img.size)
+        new_size = (int(img.size[0] * scale), int(img.size[1] * scale))
+        img = img.resize(new_size, Image.LANCZOS)
+    return img
+
+
+def prepare_target(path, max_dim=2048, cache_dir=CACHE_DIR):
+    """Load an image and build the flat per-pixel target arrays.
+
+    Returns (rgb, tgt_pos, tgt_col): the (H, W, 3) uint8 image, the (N, 2)
+    float32 (x, y) position and the (N, 3) float32 color of every pixel in
+    row-major order. The arrays are cached in `cache_dir` keyed by the file
+    hash and `max_dim`; a cache hit is memory-mapped, so reopening the same
+    image skips decoding and resizing altogether.
+    """
+    cache = None
+    if cache_dir:
+        cache = os.path.join(cache_dir, f"prep-{file_digest(path)}-{max_dim}")
+        try:
+            return tuple(np.load(os.path.join(cache, name + ".npy"), mmap_mode="r")
+                         for name in ("rgb", "pos", "col"))
+        except (OSError, ValueError):
+            pass
+
+    rgb = np.asarray(load_image(path, max_dim), dtype=np.uint8)
+    h, w = rgb.shape[:2]
+    ys, xs = np.indices((h, w), dtype=np.float32)
+    tgt_pos = np.column_stack((xs.ravel(), ys.ravel()))
+    tgt_col = rgb.reshape(-1, 3).astype(np.float32)
+
+    if cache:
+        try:
+            os.makedirs(cache, exist_ok=True)
+            for name, arr in (("rgb", rgb), ("pos", tgt_pos), ("col", tgt_col)):
+                tmp = os.path.join(cache, name + ".tmp.npy")
+                np.save(tmp, arr)
+                os.replace(tmp, os.path.join(cache, name + ".npy"))
+        except OSError:
+            pass
+    return rgb, tgt_pos, tgt_col
+
+
+class ParticleStore:
+    """Structure-of-arrays storage for drawn particles.
+
+    Particle i lives at index i of a few preallocated arrays (position, target
+    index, color, settled flag). The arrays grow by doubling, so spawning is
+    amortised O(1) and the per-frame motion is one vectorised update instead
+    of a Python loop over dicts.
+    """
+
+    def __init__(self, capacity=4096):
+        capacity = max(1, int(capacity))
+        self.size = 0
+        self.pos = np.empty((capacity, 2), dtype=np.float32)
+        self.target_idx = np.empty(capacity, dtype=np.int64)
+        self.color = np.empty((capacity, 3), dtype=np.uint8)
+        self.settled = np.zeros(capacity, dtype=bool)
+        self.settled_count = 0
+        # settled particles dropped from the arrays by compact()
+        self.retired = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.pos)
+
+    @property
+    def live_count(self):
+        """Number of particles spawned so far, including compacted ones."""
+        return self.size + self.retired
+
+    @property
+    def moving_count(self):
+        return self.live_count - self.settled_count
+
+    def _grow(self, needed):
+        cap = self.capacity
+        while cap < needed:
+            cap *= 2
+        if cap == self.capacity:
+            return
+        n = self.size
+        for name in ("pos", "target_idx", "color", "settled"):
+            old = getattr(self, name)
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def add(self, positions, target_idx, colors):
+        """Append a batch of particles.
+
+        `positions` is (m, 2), `target_idx` is (m,), `colors` is either one RGB
+        triple shared by the whole batch or an (m, 3) array.
+        """
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        m = len(positions)
+        if m == 0:
+            return
+        self._grow(self.size + m)
+        s = slice(self.size, self.size + m)
+        self.pos[s] = positions
+        self.target_idx[s] = target_idx
+        self.color[s] = colors
+        self.settled[s] = False
+        self.size += m
+
+    def update(self, tgt_pos_f, speed=0.05, snap_dist=0.5):
+        """Move every unsettled particle towards its target.
+
+        Particles further than `snap_dist` move `speed` of the remaining way,
+        the rest snap onto the target and are marked settled. Returns the
+        indices that settled during this call.
+        """
+        moving = np.flatnonzero(~self.settled[:self.size])
+        if moving.size == 0:
+            return moving
+        pos = self.pos[moving]
+        tgt = tgt_pos_f[self.target_idx[moving]]
+        delta = tgt - pos
+        dist = np.sqrt(np.einsum("ij,ij->i", delta, delta))
+        far = dist > snap_dist
+        pos[far] += delta[far] * speed
+        pos[~far] = tgt[~far]
+        self.pos[moving] = pos
+        newly = moving[~far]
+        self.settled[newly] = True
+        self.settled_count += newly.size
+        return newly
+
+    def compact(self, min_fraction=0.5):
+        """Drop settled particles from the arrays.
+
+        Only does the copy once at least `min_fraction` of the stored
+        particles have settled, so the cost is amortised. Settled particles
+        are expected to have been burned into a background by then.
+        """
+        n = self.size
+        done = self.settled_count - self.retired
+        if done == 0 or done < min_fraction * n:
+            return
+        keep = np.flatnonzero(~self.settled[:n])
+        m = keep.size
+        self.pos[:m] = self.pos[keep]
+        self.target_idx[:m] = self.target_idx[keep]
+        self.color[:m] = self.color[keep]
+        self.settled[:n] = False
+        self.size = m
+        self.retired += n - m
+
+
+def disk_offsets(radius):
+    """(dx, dy) offsets of a filled disk of the given radius."""
+    r = int(radius)
+    ys, xs = np.mgrid[-r:r + 1, -r:r + 1]
+    keep = xs * xs + ys * ys <= r * r
+    return np.column_stack((xs[keep], ys[keep]))
+
+
+def stamp_disks(pixels, positions, colors, radius=2):
+    """Write filled disks into a (width, height, 3) array.
+
+    `pixels` uses the surfarray layout (x first), so it can be the array from
+    `pygame.surfarray.pixels3d`. One fancy-indexed write per disk offset, so
+    the cost is independent of how many Python objects are involved. Later
+    particles win where disks overlap, same as sequential draw calls.
+    """
+    if len(positions) == 0:
+        return
+    w, h = pixels.shape[:2]
+    xy = np.asarray(positions).astype(np.int64)
+    colors = np.asarray(colors, dtype=np.uint8)
+    for dx, dy in disk_offsets(radius):
+        x = xy[:, 0] + dx
+        y = xy[:, 1] + dy
+        ok = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        pixels[x[ok], y[ok]] = colors[ok]
+
+
+def spawn_brush(particles, matcher, x, y, brush_size, color, rng=np.random):
+    """Spawn one brush dab at (x, y).
+
+    `brush_size` particles are placed uniformly inside a circle of that
+    radius and all of them are matched to targets with one batched query.
+    `rng` is anything with a NumPy-style `random(n)`.
+    """
+    n = max(1, int(brush_size))
+    r = brush_size * np.sqrt(rng.random(n))
+    theta = 2 * np.pi * rng.random(n)
+    pts = np.column_stack((x + r * np.cos(theta), y + r * np.sin(theta)))
+    idxs = matcher.assign(np.tile(color, (n, 1)))
+    particles.add(pts, idxs, color)
+    return n
+
+
+class TargetMatcher:
+    """Assigns requested colors to target pixels of similar color.
+
+    A single cKDTree over the target colors answers a whole batch of requests
+    in one query. Each target pixel is handed out at most once (tracked in
+    `used`) so draws spread across the image; pixels only get reused once no
+    unused ones remain.
+
+    With `lut_bits` set, the KD-trees are skipped and requests are served
+    from a QuantizedColorLUT instead (built once, cached in `cache_dir`).
+    `used` may be passed in to share the mask (e.g. a view into shared
+    memory); it must start out all False.
+    """
+
+    def __init__(self, tgt_col, k=50, lut_bits=None, cache_dir=CACHE_DIR, used=None):
+        self.tgt_col = np.ascontiguousarray(tgt_col, dtype=np.float32)
+        n = len(self.tgt_col)
+        self.used = np.zeros(n, dtype=bool) if used is None else used
+        self.used_count = 0
+        self.k = max(1, min(k, n))
+        if lut_bits:
+            self.lut = QuantizedColorLUT(self.tgt_col, self.used, lut_bits, cache_dir)
+            self.tree = None
+            self.unused_index = None
+            return
+        self.lut = None
+        self.tree = cKDTree(self.tgt_col) if n else None
+        # nearest-unused lookups once all k candidates are taken
+        self.unused_index = UnusedColorIndex(self.tgt_col, self.used)
+
+    def __len__(self):
+        return len(self.tgt_col)
+
+    def _claim(self, idx):
+        self.used[idx] = True
+        self.used_count += len(idx)
+
+    def assign(self, colors):
+        """Return one target index per requested color (shape (m,))."""
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        m = len(colors)
+        out = np.zeros(m, dtype=np.int64)
+        if m == 0 or len(self) == 0:
+            return out
+        if self.lut is not None:
+            return self._assign_lut(colors)
+        _, cand = self.tree.query(colors, k=self.k, workers=-1)
+        cand = np.asarray(cand).reshape(m, -1)
+
+        # Walk the candidate columns nearest-first. Every pending request
+        # tries its j-th candidate; when several want the same free pixel
+        # the earliest request in the batch wins and the rest move on.
+        pending = np.arange(m)
+        for j in range(cand.shape[1]):
+            if pending.size == 0:
+                break
+            c = cand[pending, j]
+            free = np.flatnonzero(~self.used[c])
+            if free.size == 0:
+                continue
+            picks, first = np.unique(c[free], return_index=True)
+            winners = free[first]
+            out[pending[winners]] = picks
+            self._claim(picks)
+            pending = np.delete(pending, winners)
+
+        if pending.size:
+            out[pending] = self._assign_unused(colors[pending], cand[pending, 0])
+        return out
+
+    def _assign_unused(self, colors, nearest):
+        """Nearest unused pixels for requests whose k candidates were taken."""
+        out = nearest.copy()
+        # brush batches are usually one color, so group identical requests
+        # and fetch the g best unused pixels per group with one lookup
+        uniq, inverse = np.unique(colors, axis=0, return_inverse=True)
+        for g, color in enumerate(uniq):
+            rows = np.flatnonzero(inverse.ravel() == g)
+            picks = self.unused_index.nearest(color, rows.size, self.used_count)
+            if picks.size == 0:
+                # nothing left: allow reuse of the overall nearest
+                break
+            out[rows[:picks.size]] = picks
+            self._claim(picks)
+        return out
+
+
+    def _assign_lut(self, colors):
+        out = np.empty(len(colors), dtype=np.int64)
+        uniq, inverse = np.unique(colors, axis=0, return_inverse=True)
+        for g, color in enumerate(uniq):
+            rows = np.flatnonzero(inverse.ravel() == g)
+            picks = self.lut.pop(color, rows.size)
+            self._claim(picks)
+            out[rows[:picks.size]] = picks
+            # nothing unused left: reuse the best static match
+            out[rows[picks.size:]] = self.lut.best(color)
+        return out
+
+
+class QuantizedColorLUT:
+    """Target pixels bucketed into a (2**bits)**3 RGB cube.
+
+    The pixels of every cell are stored contiguously in `order`, nearest to
+    the cell center first, with a head pointer per cell. Asking for the next
+    best unused pixel for a color is then a pop from the front of its cell;
+    only when that cell runs dry is the nearest non-empty cell looked up.
+    The sorted layout only depends on the image, so it is cached on disk.
+    """
+
+    def __init__(self, tgt_col, used, bits=5, cache_dir=CACHE_DIR):
+        self.bits = int(bits)
+        self.shift = 8 - self.bits
+        self.used = used
+        side = 1 << self.bits
+        data = None
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, f"lut{self.bits}-{array_digest(tgt_col)}.npz")
+            try:
+                with np.load(path) as f:
+                    data = f["order"], f["starts"]
+                if data[0].shape != (len(tgt_col),) or data[1].shape != (side ** 3 + 1,):
+                    raise ValueError(path)
+            except Exception:
+                # missing, or cut short by an interrupted run (BadZipFile
+                # and friends): build it again
+                data = None
+        if data is None:
+            data = self._build(tgt_col)
+            if path:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    tmp = path[:-len(".npz")] + ".tmp.npz"
+                    np.savez(tmp, order=data[0], starts=data[1])
+                    os.replace(tmp, path)
+                except OSError:
+                    pass
+        self.order, starts = data
+        self.start = starts[:-1].astype(np.int64)
+        self.end = starts[1:].astype(np.int64)
+        self.head = self.start.copy()
+        q = np.indices((side, side, side)).reshape(3, -1).T
+        self.centers = self._center(q)
+        self._alive = np.flatnonzero(self.start < self.end)
+
+    def _center(self, q):
+        return ((q << self.shift) + ((1 << self.shift) - 1) / 2).astype(np.float32)
+
+    def cell_of(self, colors):
+        q = np.clip(np.asarray(colors), 0, 255).astype(np.int64) >> self.shift
+        return (q[..., 0] << (2 * self.bits)) | (q[..., 1] << self.bits) | q[..., 2]
+
+    def _build(self, tgt_col):
+        q = tgt_col.astype(np.int64) >> self.shift
+        cell = self.cell_of(tgt_col)
+        diff = tgt_col - self._center(q)
+        d2 = np.einsum("ij,ij->i", diff, diff)
+        order = np.lexsort((d2, cell)).astype(np.int32)
+        starts = np.searchsorted(cell[order], np.arange((1 << self.bits) ** 3 + 1)).astype(np.int32)
+        return order, starts
+
+    def _take(self, cell, count):
+        """Pop up to `count` unused pixels off the front of one cell."""
+        h, e = self.head[cell], self.end[cell]
+        got = []
+        while count > 0 and h < e:
+            run = self.order[h:min(e, h + max(2 * count, 64))]
+            free = np.flatnonzero(~self.used[run])
+            if free.size > count:
+                free = free[:count]
+                h += int(free[-1]) + 1
+            else:
+                h += run.size
+            got.append(run[free])
+            count -= free.size
+        self.head[cell] = h
+        return np.concatenate(got) if got else np.empty(0, dtype=self.order.dtype)
+
+    def _cells_by_distance(self, color, nearest=64):
+        """Non-empty cells, nearest to `color` first (sorted lazily)."""
+        cells = self._alive
+        self._alive = cells = cells[self.head[cells] < self.end[cells]]
+        diff = self.centers[cells] - np.asarray(color, dtype=np.float32)
+        d2 = np.einsum("ij,ij->i", diff, diff)
+        if cells.size > nearest:
+            part = np.argpartition(d2, nearest)
+            near, rest = part[:nearest], part[nearest:]
+            yield from cells[near[np.argsort(d2[near])]].tolist()
+            cells, d2 = cells[rest], d2[rest]
+        yield from cells[np.argsort(d2)].tolist()
+
+    def pop(self, color, count):
+        """Up to `count` unused pixel indices for `color`, best first."""
+        got = [self._take(int(self.cell_of(color)), count)]
+        count -= got[0].size
+        if count > 0:
+            # own cell ran dry: continue with the nearest non-empty cells
+            for cell in self._cells_by_distance(color):
+                picks = self._take(cell, count)
+                got.append(picks)
+                count -= picks.size
+                if count == 0:
+                    break
+        return np.concatenate(got).astype(np.int64)
+
+    def best(self, color):
+        """Best match for `color` ignoring whether it was already used."""
+        cell = int(self.cell_of(color))
+        if self.start[cell] == self.end[cell]:
+            cells = np.flatnonzero(self.start < self.end)
+            diff = self.centers[cells] - np.asarray(color, dtype=np.float32)
+            cell = int(cells[np.argmin(np.einsum("ij,ij->i", diff, diff))])
+        return int(self.order[self.start[cell]])
+
+
+class UnusedColorIndex:
+    """KD-tree over the target colors that were unused when it was built.
+
+    Claimed pixels stay in the tree as tombstones and are filtered out with
+    the shared `used` mask; once they make up `rebuild_fraction` of the tree
+    it is rebuilt from the pixels still unused. Lookups therefore stay
+    sublinear for the whole session instead of rescanning every unused pixel.
+
+    Strokes repeat the same color many times, so the sorted result of the
+    last query per color is kept and handed out front to back. Everything in
+    the tree that is not in that list is further away, so popping from it
+    gives the same answer as a fresh query.
+    """
+
+    def __init__(self, colors, used, rebuild_fraction=0.25, cache_colors=64):
+        self.colors = colors
+        self.used = used
+        self.rebuild_fraction = rebuild_fraction
+        self.cache_colors = cache_colors
+        self.rebuilds = 0
+        self._build(0)
+
+    def _build(self, used_count):
+        self.ids = np.flatnonzero(~self.used)
+        self.tree = cKDTree(self.colors[self.ids]) if self.ids.size else None
+        # every claim after this point kills exactly one entry of the tree
+        self._built_at = used_count
+        # color -> (candidate ids nearest first, k they were queried with)
+        self._runs = {}
+        self.rebuilds += 1
+
+    def __len__(self):
+        return self.ids.size
+
+    def tombstones(self, used_count):
+        return used_count - self._built_at
+
+    def nearest(self, color, count, used_count):
+        """Up to `count` unused indices closest to `color`, nearest first.
+
+        `used_count` is the number of claimed pixels so far, used to tell how
+        many tombstones the tree holds.
+        """
+        if self.tombstones(used_count) > self.rebuild_fraction * len(self):
+            self._build(used_count)
+        size = len(self)
+        if size == 0 or self.tombstones(used_count) >= size:
+            return np.empty(0, dtype=np.int64)
+        key = tuple(np.asarray(color).tolist())
+        alive, k = self._runs.pop(key, (None, 0))
+        if alive is not None:
+            alive = alive[~self.used[alive]]
+        if alive is None or (alive.size < count and k < size):
+            k = min(max(4 * k, 4 * count, 64), size)
+            while True:
+                _, j = self.tree.query(color, k=k)
+                ids = self.ids[np.atleast_1d(j)]
+                alive = ids[~self.used[ids]]
+                if alive.size >= count or k == size:
+                    break
+                k = min(k * 4, size)
+        if len(self._runs) >= self.cache_colors:
+            self._runs.pop(next(iter(self._runs)))
+        self._runs[key] = (alive[count:], k)
+        return alive[:count]
+
+
+# === TILES ===
+
+def _tile_worker(conn, names, n, lo, hi, lut_bits):
+    """Owns target pixels [lo, hi): builds their index and serves requests."""
+    col_shm, used_shm, out_shm = (shared_memory.SharedMemory(name=name) for name in names)
+    col = np.ndarray((n, 3), dtype=np.float32, buffer=col_shm.buf)
+    used = np.ndarray((n,), dtype=bool, buffer=used_shm.buf)
+    out = np.ndarray((TiledMatcher.BATCH,), dtype=np.int64, buffer=out_shm.buf)
+    matcher = TargetMatcher(col[lo:hi], lut_bits=lut_bits, used=used[lo:hi])
+    conn.send(matcher.used_count)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        if msg[0] == "claim":
+            matcher._claim(msg[1])
+        else:
+            _, rows, colors = msg
+            out[rows] = matcher.assign(colors) + lo
+        conn.send(matcher.used_count)
+    del col, used, out
+    for shm in (col_shm, used_shm, out_shm):
+        shm.close()
+
+
+class TiledMatcher:
+    """TargetMatcher split across worker processes.
+
+    The target pixels are cut into `tiles` contiguous row bands. Each band
+    has its own index, built and owned by one worker process, and its slice
+    of the used-mask. Colors and the used-mask live in shared memory, and
+    so does the buffer the workers write their answers into, so only small
+    request lists go through the pipes.
+
+    Requests are routed with a coarse per-tile color histogram of unused
+    pixels. Each color goes to the tiles that still have pixels in its bin,
+    split in proportion to how many they have. A request gets the best
+    unused pixel of the tile it lands in, not necessarily of the whole
+    image. Index builds and lookups then scale across cores, so images
+    beyond MAX_DIM work without downscaling.
+    """
+
+    BATCH = 4096
+
+    def __init__(self, tgt_col, tiles=None, lut_bits=None, hist_bits=4):
+        tgt_col = np.asarray(tgt_col, dtype=np.float32)
+        n = len(tgt_col)
+        tiles = max(1, min(int(tiles or os.cpu_count() or 1), max(1, n)))
+        self.bounds = np.linspace(0, n, tiles + 1).astype(np.int64)
+        self._shm = [
+            shared_memory.SharedMemory(create=True, size=max(1, tgt_col.nbytes)),
+            shared_memory.SharedMemory(create=True, size=max(1, n)),
+            shared_memory.SharedMemory(create=True, size=self.BATCH * 8),
+        ]
+        self.tgt_col = np.ndarray((n, 3), dtype=np.float32, buffer=self._shm[0].buf)
+        self.tgt_col[:] = tgt_col
+        self.used = np.ndarray((n,), dtype=bool, buffer=self._shm[1].buf)
+        self.used[:] = False
+        self._out = np.ndarray((self.BATCH,), dtype=np.int64, buffer=self._shm[2].buf)
+        names = [shm.name for shm in self._shm]
+
+        self._conns = []
+        self._procs = []
+        for t in range(tiles):
+            parent, child = mp.Pipe()
+            proc = mp.Process(target=_tile_worker, daemon=True,
+                              args=(child, names, n, self.bounds[t], self.bounds[t + 1], lut_bits))
+            proc.start()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        self.tile_used = np.array([conn.recv() for conn in self._conns], dtype=np.int64)
+
+        self.hist_shift = 8 - hist_bits
+        self.hist_bits = hist_bits
+        self.hist = np.stack([self._tile_hist(t) for t in range(tiles)])
+
+    @property
+    def tiles(self):
+        return len(self._conns)
+
+    @property
+    def used_count(self):
+        return int(self.tile_used.sum())
+
+    def __len__(self):
+        return len(self.tgt_col)
+
+    def _bins(self, colors):
+        q = np.clip(colors, 0, 255).astype(np.int64) >> self.hist_shift
+        b = self.hist_bits
+        return (q[..., 0] << (2 * b)) | (q[..., 1] << b) | q[..., 2]
+
+    def _tile_hist(self, t):
+        lo, hi = self.bounds[t], self.bounds[t + 1]
+        free = np.flatnonzero(~self.used[lo:hi]) + lo
+        return np.bincount(self._bins(self.tgt_col[free]), minlength=1 << (3 * self.hist_bits))
+
+    def _route(self, colors):
+        """Split request rows between tiles, returns one row array per tile."""
+        plan = [[] for _ in range(self.tiles)]
+        free = np.diff(self.bounds) - self.tile_used
+        uniq, inverse = np.unique(colors, axis=0, return_inverse=True)
+        bins = self._bins(uniq)
+        for g in range(len(uniq)):
+            rows = np.flatnonzero(inverse.ravel() == g)
+            weights = self.hist[:, bins[g]].astype(np.float64)
+            if weights.sum() < rows.size:
+                weights = weights + free
+            if weights.sum() <= 0:
+                weights = np.ones(self.tiles)
+            share = rows.size * weights / weights.sum()
+            counts = np.floor(share).astype(np.int64)
+            extra = rows.size - counts.sum()
+            counts[np.argsort(counts - share)[:extra]] += 1
+            if rows.size <= free.sum():
+                # never send a tile more requests than it has unused pixels
+                spill = int(np.maximum(counts - free, 0).sum())
+                counts = np.minimum(counts, free)
+                while spill:
+                    t = int(np.argmax(free - counts))
+                    take = min(spill, int(free[t] - counts[t]))
+                    counts[t] += take
+                    spill -= take
+            free = np.maximum(free - counts, 0)
+            for t, part in enumerate(np.split(rows, np.cumsum(counts)[:-1])):
+                if part.size:
+                    plan[t].append(part)
+        return [np.concatenate(p) if p else None for p in plan]
+
+    def assign(self, colors):
+        """Return one target index per requested color (shape (m,))."""
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        out = np.zeros(len(colors), dtype=np.int64)
+        if len(self) == 0:
+            return out
+        for start in range(0, len(colors), self.BATCH):
+            chunk = colors[start:start + self.BATCH]
+            plan = self._route(chunk)
+            busy = [t for t, rows in enumerate(plan) if rows is not None]
+            for t in busy:
+                self._conns[t].send(("assign", plan[t], chunk[plan[t]]))
+            for t in busy:
+                before = self.tile_used[t]
+                self.tile_used[t] = self._conns[t].recv()
+                if self.tile_used[t] - before == plan[t].size:
+                    ids = self._out[plan[t]]
+                    np.subtract.at(self.hist[t], self._bins(self.tgt_col[ids]), 1)
+                else:
+                    # the tile ran out and reused pixels: recount from the mask
+                    self.hist[t] = self._tile_hist(t)
+            out[start:start + len(chunk)] = self._out[:len(chunk)]
+        return out
+
+    def claim(self, idx):
+        """Mark target pixels `idx` used without assigning them.
+
+        Goes through the owning workers, so their used counts and
+        tombstone rebuilds see the pixels as well as the routing here."""
+        idx = np.unique(np.asarray(idx, dtype=np.int64))
+        idx = idx[~self.used[idx]]
+        tiles = np.searchsorted(self.bounds, idx, side="right") - 1
+        busy = np.unique(tiles)
+        for t in busy:
+            self._conns[t].send(("claim", idx[tiles == t] - self.bounds[t]))
+        for t in busy:
+            self.tile_used[t] = self._conns[t].recv()
+            self.hist[t] = self._tile_hist(t)
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, EOFError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._conns, self._procs = [], []
+        self.tgt_col = self.used = self._out = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def make_matcher(tgt_col, lut_bits=None, tiles=0):
+    """TargetMatcher, or a TiledMatcher when `tiles` is set."""
+    if tiles:
+        return TiledMatcher(tgt_col, tiles=tiles, lut_bits=lut_bits)
+    return TargetMatcher(tgt_col, lut_bits=lut_bits)
+
+
+# === PROFILING ===
+
+class FrameProfiler:
+    """Per-stage frame timing with rolling percentiles.
+
+    Wrap each part of a frame in `with profiler.stage(name):` and call
+    `end_frame()` once per frame. Nested stages are exclusive: time spent in
+    an inner stage is not counted for the outer one. The last `window`
+    frames are kept for percentiles; with `trace_path` every frame is also
+    appended to a CSV file (milliseconds per stage plus the busy total).
+    """
+
+    STAGES = ("events", "assign", "physics", "draw", "ui")
+
+    def __init__(self, stages=STAGES, window=300, trace_path=None):
+        self.stages = tuple(stages)
+        self._col = {name: i for i, name in enumerate(self.stages)}
+        # last column is the frame's busy total
+        self.samples = np.zeros((window, len(self.stages) + 1))
+        self.count = 0
+        self._current = np.zeros(len(self.stages))
+        self._stack = []
+        self._trace = None
+        if trace_path:
+            self._trace = open(trace_path, "w")
+            self._trace.write(",".join(("frame",) + self.stages + ("total",)) + "\n")
+
+    @contextmanager
+    def stage(self, name):
+        col = self._col[name]
+        self._stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t
+            inner = self._stack.pop()
+            self._current[col] += elapsed - inner
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def end_frame(self):
+        row = self.samples[self.count % len(self.samples)]
+        row[:-1] = self._current * 1000.0
+        row[-1] = row[:-1].sum()
+        if self._trace:
+            self._trace.write(f"{self.count}," + ",".join(f"{v:.3f}" for v in row) + "\n")
+        self.count += 1
+        self._current[:] = 0.0
+
+    def percentiles(self, q=(50, 95, 99)):
+        """{stage: (p50, p95, p99)} in ms over the rolling window, plus "total"."""
+        n = min(self.count, len(self.samples))
+        if n == 0:
+            return {}
+        p = np.percentile(self.samples[:n], q, axis=0)
+        return {name: tuple(p[:, i]) for i, name in enumerate(self.stages + ("total",))}
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+
+# === HEADLESS ===
+# A stroke is {"color": [r, g, b], "brush": radius, "points": [[x, y], ...]};
+# every point is one frame with the mouse held down at that position.
+
+def load_strokes(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_strokes(path, strokes):
+    with open(path, "w") as f:
+        json.dump(strokes, f)
+
+
+def random_strokes(count, width, height, rng, palette=None, length=30, max_brush=60):
+    """Procedural strokes: random walks with random brush sizes.
+
+    Colors are drawn from `palette` (an (N, 3) array, e.g. the target colors)
+    when given, otherwise uniformly from the RGB cube.
+    """
+    strokes = []
+    for _ in range(count):
+        if palette is not None and len(palette):
+            color = np.asarray(palette[rng.integers(len(palette))]).astype(int)
+        else:
+            color = rng.integers(0, 256, 3)
+        steps = rng.normal(0, 8, (length, 2))
+        steps[0] = (rng.random() * width, rng.random() * height)
+        pts = np.cumsum(steps, axis=0)
+        pts[:, 0] = np.clip(pts[:, 0], 0, width - 1)
+        pts[:, 1] = np.clip(pts[:, 1], 0, height - 1)
+        strokes.append({
+            "color": [int(c) for c in color],
+            "brush": int(rng.integers(1, max_brush + 1)),
+            "points": np.round(pts, 1).tolist(),
+        })
+    return strokes
+
+
+def play_frames(rgb, tgt_pos, tgt_col, frames, lut_bits=None, tiles=0, seed=0,
+                realtime=False, frames_dir=None, frame_every=1, max_settle_frames=5000,
+                radius=2, bg=(20, 20, 20)):
+    """Feed input frames through the matching and motion engines without a window.
+
+    `frames` yields (dt_ms, dabs) pairs, each dab being (x, y, brush, color)
+    as passed to spawn_brush. Frames run as fast as possible, or paced by
+    their dt_ms with `realtime`. Afterwards frames continue until every
+    particle has settled (or `max_settle_frames` pass). With `frames_dir`
+    every `frame_every`-th frame is written there as a PNG. Returns the final
+    (H, W, 3) image and a dict of counters and timings.
+    """
+    h, w = rgb.shape[:2]
+    rng = np.random.default_rng(seed)
+    t0 = time.perf_counter()
+    matcher = make_matcher(tgt_col, lut_bits=lut_bits, tiles=tiles)
+    particles = ParticleStore()
+    canvas = np.empty((w, h, 3), dtype=np.uint8)
+    canvas[:] = bg
+    stats = {"index_build_s": time.perf_counter() - t0, "assign_s": 0.0,
+             "update_s": 0.0, "frames": 0, "frames_written": 0}
+    if frames_dir:
+        os.makedirs(frames_dir, exist_ok=True)
+
+    def frame(dabs=()):
+        t = time.perf_counter()
+        for dab in dabs:
+            spawn_brush(particles, matcher, *dab, rng=rng)
+        stats["assign_s"] += time.perf_counter() - t
+        t = time.perf_counter()
+        settled = particles.update(tgt_pos)
+        stamp_disks(canvas, particles.pos[settled], particles.color[settled], radius)
+        stats["update_s"] += time.perf_counter() - t
+        if frames_dir and stats["frames"] % frame_every == 0:
+            out = canvas.copy()
+            moving = np.flatnonzero(~particles.settled[:len(particles)])
+            stamp_disks(out, particles.pos[moving], particles.color[moving], radius)
+            name = os.path.join(frames_dir, f"frame_{stats['frames_written']:05d}.png")
+            Image.fromarray(out.transpose(1, 0, 2)).save(name)
+            stats["frames_written"] += 1
+        particles.compact()
+        stats["frames"] += 1
+
+    try:
+        deadline = time.perf_counter()
+        for dt_ms, dabs in frames:
+            if realtime:
+                deadline += dt_ms / 1000.0
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            frame(dabs)
+        for _ in range(max_settle_frames):
+            if particles.moving_count == 0:
+                break
+            frame()
+    finally:
+        if tiles:
+            matcher.close()
+
+    stats.update(particles=particles.live_count, settled=particles.settled_count,
+                 targets_used=matcher.used_count,
+                 total_s=time.perf_counter() - t0)
+    return canvas.transpose(1, 0, 2).copy(), stats
+
+
+def render_offline(rgb, tgt_pos, tgt_col, strokes, **kwargs):
+    """Play strokes (one point per frame) through play_frames."""
+    frames = ((0, [(x, y, stroke["brush"], np.asarray(stroke["color"], dtype=np.int64))])
+              for stroke in strokes for x, y in stroke["points"])
+    return play_frames(rgb, tgt_pos, tgt_col, frames, **kwargs)
+
+
+# === RECORDING ===
+# Session files: a header, then a stream of tagged little-endian records.
+#   b"F" uint16 dt_ms              end of a frame
+#   b"M" float32 x, y, uint8 btn   mouse moved or buttons changed
+#   b"C" uint8 r, g, b, brush      color/brush sliders changed
+#   b"D" float32 x, y              brush dab with the current color/brush
+# Dabs use the RNG seeded from the header, so replaying the same file on the
+# same image (and matcher settings) reproduces the session exactly.
+
+SESSION_MAGIC = b"PXREC\x01"
+_HEADER = struct.Struct("<qIIbh16s")
+_RECORDS = {b"F": struct.Struct("<H"), b"M": struct.Struct("<ffB"),
+            b"C": struct.Struct("<BBBB"), b"D": struct.Struct("<ff")}
+
+
+class SessionRecorder:
+    """Writes interactive input to a session file for later replay."""
+
+    def __init__(self, path, seed, width, height, digest, lut_bits=None, tiles=0):
+        self._f = open(path, "wb")
+        self._f.write(SESSION_MAGIC)
+        self._f.write(_HEADER.pack(seed, width, height, lut_bits or 0, tiles or 0, digest.encode()[:16]))
+        self._mouse = None
+        self._state = None
+
+    def _write(self, tag, *values):
+        self._f.write(tag + _RECORDS[tag].pack(*values))
+
+    def mouse(self, x, y, buttons):
+        mouse = (float(x), float(y), int(buttons))
+        if mouse != self._mouse:
+            self._mouse = mouse
+            self._write(b"M", *mouse)
+
+    def state(self, color, brush):
+        state = tuple(int(c) for c in color) + (int(brush),)
+        if state != self._state:
+            self._state = state
+            self._write(b"C", *state)
+
+    def dab(self, x, y):
+        self._write(b"D", float(x), float(y))
+
+    def frame(self, dt_ms):
+        self._write(b"F", max(0, min(int(dt_ms), 0xFFFF)))
+
+    def close(self):
+        self._f.close()
+
+
+def read_session(path):
+    """Return (header, frames) of a session file.
+
+    `frames` is a list of (dt_ms, dabs) ready for play_frames; a trailing
+    frame that was never closed (e.g. the window was killed) is kept.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SESSION_MAGIC):
+        raise ValueError(f"{path}: not a pixel-arranger session")
+    pos = len(SESSION_MAGIC)
+    seed, width, height, lut_bits, tiles, digest = _HEADER.unpack_from(data, pos)
+    header = {"seed": seed, "width": width, "height": height, "lut_bits": lut_bits or None,
+              "tiles": tiles, "digest": digest.rstrip(b"\0").decode()}
+    pos += _HEADER.size
+    frames = []
+    dabs = []
+    color, brush = np.zeros(3, dtype=np.int64), 1
+    while pos < len(data):
+        tag = data[pos:pos + 1]
+        rec = _RECORDS.get(tag)
+        if rec is None or pos + 1 + rec.size > len(data):
+            break
+        values = rec.unpack_from(data, pos + 1)
+        pos += 1 + rec.size
+        if tag == b"D":
+            dabs.append((values[0], values[1], brush, color))
+        elif tag == b"C":
+            color, brush = np.array(values[:3], dtype=np.int64), values[3]
+        elif tag == b"F":
+            frames.append((values[0], dabs))
+            dabs = []
+    if dabs:
+        frames.append((0, dabs))
+    return header, frames
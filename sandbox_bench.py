@@ -0,0 +1,235 @@
+"""Headless benchmark for the sandbox simulation backends.
+
+    python sandbox_bench.py --out sandbox_bench.json
+    python sandbox_bench.py --scenarios flood --steps 1000 --compare sandbox_bench.json
+
+Fills the grid with a preset scenario, runs N steps on every backend
+without opening a window and reports steps/s and cells/s.  The final
+grid of each backend is hashed and checked against its reference: the
+chunked backends must match the whole-grid numpy step cell for cell and
+the strip stepper must match the same strip schedule run in one process.
+The python loop is the original rules and only matches itself.  The
+numpy step leaves out its left-to-right drift, so when both run, how far
+apart their final grids are (column heights, counts of each element) is
+reported under the numpy result as "vs_python".  With --compare every
+hash is also checked against an earlier run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+import sandbox_game
+from sandbox_engine import (CELL_DIRT, CELL_EMPTY, CELL_SAND, CELL_SNOW, CELL_SODIUM, CELL_WATER,
+                            ChunkedWorld, ChunkTracker, Explosions, StripStepper, step_strips, update_array_grid,
+                            update_chunks)
+
+SCENARIOS = ("avalanche", "flood", "sodium", "mixed")
+BACKENDS = ("python", "numpy", "chunks", "world", "strips2")
+
+
+def scenario(name, width, height, seed=0):
+    """A (height, width) uint8 grid with the named preset."""
+    rng = np.random.default_rng(seed)
+    grid = np.zeros((height, width), dtype=np.uint8)
+    ys, xs = np.mgrid[0:height, 0:width]
+    if name == "avalanche":
+        # a steep wedge of sand held up by nothing, over a dirt slope
+        grid[ys < height - (height // 2) * xs / width] = CELL_SAND
+        grid[:height // 4] = CELL_EMPTY
+        grid[ys > height - 1 - (height // 8) * xs / width] = CELL_DIRT
+    elif name == "flood":
+        # a lake dropped onto dirt hills with basins between them
+        hills = height - 1 - (height // 4) * (1 + np.sin(xs * 12 / width)) / 2
+        grid[ys > hills] = CELL_DIRT
+        grid[:height // 3, width // 8:width - width // 8] = CELL_WATER
+    elif name == "sodium":
+        # a pool of water with sodium raining into it and some mixed in
+        grid[height // 2:] = CELL_WATER
+        grid[(ys < height // 3) & (rng.random(grid.shape) < 0.15)] = CELL_SODIUM
+        grid[(ys >= height // 2) & (rng.random(grid.shape) < 0.01)] = CELL_SODIUM
+    elif name == "mixed":
+        cells = (CELL_SAND, CELL_WATER, CELL_SODIUM, CELL_DIRT, CELL_SNOW)
+        top = (ys < height // 2) & (rng.random(grid.shape) < 0.5)
+        grid[top] = rng.choice(cells, size=int(top.sum()))
+        grid[height - height // 10:] = CELL_DIRT
+    else:
+        raise ValueError(name)
+    return grid
+
+
+def grid_hash(grid):
+    return hashlib.sha1(np.ascontiguousarray(grid, dtype=np.uint8).tobytes()).hexdigest()
+
+
+def make(kind, start, seed):
+    """(step(explosions, frame), grid() -> ndarray, close) for a backend."""
+    height, width = start.shape
+    if kind == "python":
+        if start.shape != (sandbox_game.HEIGHT_CELLS, sandbox_game.WIDTH_CELLS):
+            raise ValueError(f"the python backend only runs {sandbox_game.WIDTH_CELLS}x{sandbox_game.HEIGHT_CELLS}")
+        random.seed(seed)
+        grid = start.tolist()
+        return (lambda ex, f: sandbox_game.update_grid(grid, ex, f),
+                lambda: np.array(grid, dtype=np.uint8), None)
+    if kind == "numpy":
+        grid = start.copy()
+        return lambda ex, f: update_array_grid(grid, ex, f, seed), lambda: grid, None
+    if kind == "chunks":
+        grid = start.copy()
+        tracker = ChunkTracker(width, height)
+        return lambda ex, f: update_chunks(grid, ex, f, tracker, seed), lambda: grid, None
+    if kind == "world":
+        world = ChunkedWorld(width, height)
+        world.write(0, 0, start)
+        tracker = ChunkTracker(width, height)
+        return (lambda ex, f: update_chunks(world, ex, f, tracker, seed),
+                lambda: world.read(0, height, 0, width), None)
+    if kind.startswith("strips"):
+        stepper = StripStepper(width, height, int(kind[6:]), seed)
+        stepper.grid[:] = start
+        return stepper.step, lambda: stepper.grid, stepper.close
+    raise ValueError(kind)
+
+
+def profile(grid):
+    """(height of the topmost filled cell in each column, count of each element)."""
+    filled = grid != CELL_EMPTY
+    heights = np.where(filled.any(axis=0), grid.shape[0] - filled.argmax(axis=0), 0)
+    return heights, np.bincount(grid.ravel(), minlength=CELL_SNOW + 1)
+
+
+def divergence(grid, reference):
+    """How far `grid` ended up from `reference` when they can't match cell for cell."""
+    heights, counts = profile(grid)
+    ref_heights, ref_counts = profile(reference)
+    diff = np.abs(heights - ref_heights)
+    names = {CELL_SAND: "sand", CELL_WATER: "water", CELL_SODIUM: "sodium", CELL_DIRT: "dirt", CELL_SNOW: "snow"}
+    return {"height_diff_mean": float(diff.mean()), "height_diff_max": int(diff.max()),
+            "count_diff": {name: int(counts[cell] - ref_counts[cell]) for cell, name in names.items()}}
+
+
+def reference_hash(kind, start, steps, seed, hashes):
+    """Hash `kind` has to reproduce, or None if it is a reference itself."""
+    if kind in ("chunks", "world"):
+        return hashes.get("numpy") or run_hash(update_array_grid, start, steps, seed)
+    if kind.startswith("strips"):
+        with StripStepper(start.shape[1], start.shape[0], int(kind[6:]), seed) as stepper:
+            bounds = stepper.bounds
+        return run_hash(lambda g, ex, f, s: step_strips(g, np.zeros_like(g), bounds, ex, f, s),
+                        start, steps, seed)
+    return None
+
+
+def run_hash(step, start, steps, seed):
+    grid = start.copy()
+    explosions = Explosions()
+    for frame in range(1, steps + 1):
+        step(grid, explosions, frame, seed)
+    return grid_hash(grid)
+
+
+def bench(kind, start, steps, seed):
+    """Time `steps` steps of one backend; changed cells are counted untimed.
+
+    Returns the results and the final grid."""
+    step, current, close = make(kind, start, seed)
+    explosions = Explosions()
+    elapsed = 0.0
+    changed = 0
+    try:
+        before = current().copy()
+        for frame in range(1, steps + 1):
+            t = time.perf_counter()
+            step(explosions, frame)
+            elapsed += time.perf_counter() - t
+            after = current()
+            changed += int(np.count_nonzero(after != before))
+            before = after.copy()
+    finally:
+        if close:
+            close()
+    return {"steps_per_s": steps / elapsed, "ms_per_step": 1000 * elapsed / steps,
+            "cells_per_s": start.size * steps / elapsed, "changed_per_s": changed / elapsed,
+            "hash": grid_hash(before)}, before
+
+
+def compare(new, old, path=()):
+    """Print ratios for every numeric leaf present in both runs, and any
+    hash that changed."""
+    for key, value in new.items():
+        if key == "meta" or key not in old:
+            continue
+        if isinstance(value, dict):
+            compare(value, old[key], path + (key,))
+        elif key == "hash":
+            if value != old[key]:
+                print(f"{'/'.join(path + (key,)):50s} CHANGED {old[key][:12]} -> {value[:12]}")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and old[key]:
+            ratio = value / old[key]
+            print(f"{'/'.join(path + (key,)):50s} {old[key]:12.4g} -> {value:12.4g}  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="comma separated: python, numpy, chunks, world, stripsN")
+    parser.add_argument("--size", default=f"{sandbox_game.WIDTH_CELLS}x{sandbox_game.HEIGHT_CELLS}",
+                        help="grid size WxH (the python backend only runs the default)")
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="sandbox_bench.json")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="print ratios and hash changes against an earlier run")
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.lower().split("x"))
+
+    results = {"meta": {
+        "python": sys.version.split()[0], "numpy": np.__version__,
+        "platform": platform.platform(), "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "size": f"{width}x{height}", "steps": args.steps, "seed": args.seed,
+    }}
+    mismatches = []
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        start = scenario(name, width, height, args.seed)
+        results[name] = {}
+        finals = {}
+        for kind in args.backends.split(","):
+            kind = kind.strip()
+            if kind == "python" and start.shape != (sandbox_game.HEIGHT_CELLS, sandbox_game.WIDTH_CELLS):
+                print(f"{name}: {kind} skipped (only runs the default size)", flush=True)
+                continue
+            print(f"{name}: {kind}", flush=True)
+            result, finals[kind] = bench(kind, start, args.steps, args.seed)
+            hashes = {k: v["hash"] for k, v in results[name].items()}
+            expected = reference_hash(kind, start, args.steps, args.seed, hashes)
+            if expected is not None:
+                result["matches_reference"] = result["hash"] == expected
+                if not result["matches_reference"]:
+                    mismatches.append(f"{name}/{kind}")
+            results[name][kind] = result
+        if "python" in finals and "numpy" in finals:
+            apart = results[name]["numpy"]["vs_python"] = divergence(finals["numpy"], finals["python"])
+            print(f"{name}: numpy vs python: column heights {apart['height_diff_mean']:.1f} apart on average, "
+                  f"{apart['height_diff_max']} at most", flush=True)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+    if mismatches:
+        sys.exit("final grid differs from the reference: " + ", ".join(mismatches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,939 @@
+"""Array backend for sandbox_game.py.
+
+The grid is a (height, width) uint8 array of CELL_* codes instead of a
+list of lists.  update_array_grid applies the rules of
+sandbox_game.update_grid to the whole array in a few passes:
+
+1. sodium touching water explodes,
+2. falling cells drop one row; as in the bottom-up per-cell loop a
+   falling column moves down as one block,
+3. sand, sodium and snow that could not fall slide diagonally,
+4. resting water spreads sideways.
+
+Two cells can want the same empty target (a right slide from x-1 and a
+left slide from x+1).  Slides are applied as two passes, one per
+direction, and which direction goes first alternates with the frame
+parity.
+
+The result is not the per-cell loop's.  That loop scans left to right,
+so a cell can slide right into the gap a falling column to its right has
+just left, but never left, and water that moved right is updated again.
+Here left and right are treated alike, so there is no drift.  Piles
+settle differently: the loop flows sandbox_bench's avalanche over to the
+right wall, while this backend leaves a slope (the same slope the loop
+leaves on the mirrored scene).  sandbox_bench reports how far the two
+backends end up apart.
+
+Random numbers come from cell_noise, a hash of (seed, frame, y, x), so a
+step depends only on the seed and the grid, never on the order cells
+were visited in.
+"""
+import mmap
+import multiprocessing as mp
+import os
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import ndimage
+
+# Elements: empty=0, sand=1, water=2, sodium=3, dirt=4, snow=5
+
+CELL_EMPTY = 0
+CELL_SAND = 1
+CELL_WATER = 2
+CELL_SODIUM = 3
+CELL_DIRT = 4
+CELL_SNOW = 5
+
+COLORS = {
+    CELL_EMPTY: (10, 10, 10),
+    CELL_SAND: (194, 178, 128),
+    CELL_WATER: (64, 164, 223),
+    CELL_SODIUM: (240, 240, 240),
+    CELL_DIRT: (106, 55, 5),
+    CELL_SNOW: (230, 250, 250),
+}
+
+EXPLOSION_LIFE = 8
+EXPLOSION_RADIUS = 2
+
+_MASK64 = (1 << 64) - 1
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix64(h):
+    """splitmix64 finaliser; works on Python ints and uint64 arrays alike."""
+    h ^= h >> 30
+    h = (h * 0xBF58476D1CE4E5B9) & _MASK64 if isinstance(h, int) else h * np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> 27
+    h = (h * 0x94D049BB133111EB) & _MASK64 if isinstance(h, int) else h * np.uint64(0x94D049BB133111EB)
+    h ^= h >> 31
+    return h
+
+
+def cell_noise(seed, frame, shape, y0=0, x0=0):
+    """Random uint64 per cell of a `shape` block whose top-left is (y0, x0).
+
+    The value only depends on the seed, the frame and the cell's world
+    coordinates, so any part of the world can be stepped on its own and
+    still see the same numbers.
+    """
+    key = _mix64((seed * 0x9E3779B97F4A7C15 + frame) & _MASK64)
+    ys = np.arange(y0, y0 + shape[0], dtype=np.uint64)[:, None] << np.uint64(32)
+    xs = np.arange(x0, x0 + shape[1], dtype=np.uint64)[None, :]
+    return _mix64((ys | xs) * _GOLDEN + np.uint64(key))
+
+
+def palette_lut(colors, missing=(255, 0, 255)):
+    """(256, 3) uint8 table mapping a cell code to its RGB color."""
+    lut = np.empty((256, 3), dtype=np.uint8)
+    lut[:] = missing
+    for cell, color in colors.items():
+        lut[cell] = color
+    return lut
+
+
+class Explosions:
+    """Cells flashing after a blast, with the frames each has left.
+
+    Stored as parallel x, y, life arrays with one entry per cell: a cell
+    caught by several blasts keeps the longest life.  New cells are queued
+    and merged in once per step by decay(), which then ages every cell
+    with one vectorized decrement and drops the ones that ran out.
+    append/extend take [x, y, life] items like the old list did.
+    """
+
+    def __init__(self):
+        self.x = np.zeros(0, dtype=np.int32)
+        self.y = np.zeros(0, dtype=np.int32)
+        self.life = np.zeros(0, dtype=np.int16)
+        self._new = []  # (x, y, life) arrays added since the last merge
+
+    def __len__(self):
+        return len(self.x) + sum(len(x) for x, _, _ in self._new)
+
+    def add(self, x, y, life=EXPLOSION_LIFE):
+        """Flash the cells at x, y (arrays or scalars) for `life` frames."""
+        x = np.asarray(x, dtype=np.int32).ravel()
+        y = np.asarray(y, dtype=np.int32).ravel()
+        self._new.append((x, y, np.full(len(x), life, dtype=np.int16)))
+
+    def append(self, item):
+        x, y, life = item
+        self.add(x, y, life)
+
+    def extend(self, items):
+        """Add [x, y, life] items, or all cells of another Explosions."""
+        if isinstance(items, Explosions):
+            self._new.append(items.cells())
+            return
+        items = np.asarray(list(items), dtype=np.int32).reshape(-1, 3)
+        self._new.append((items[:, 0], items[:, 1], items[:, 2].astype(np.int16)))
+
+    def clear(self):
+        self.__init__()
+
+    def cells(self):
+        """(x, y, life) arrays, one entry per flashing cell."""
+        if self._new:
+            self._new.append((self.x, self.y, self.life))
+            x, y, life = (np.concatenate(parts) for parts in zip(*self._new))
+            self._new = []
+            # sort by cell, then life, and keep each cell's last (longest) entry
+            key = (y.astype(np.int64) << 32) | (x.astype(np.int64) & 0xffffffff)
+            order = np.lexsort((life, key))
+            key = key[order]
+            last = np.ones(len(key), dtype=bool)
+            last[:-1] = key[1:] != key[:-1]
+            keep = order[last]
+            self.x, self.y, self.life = x[keep], y[keep], life[keep]
+        return self.x, self.y, self.life
+
+    def decay(self):
+        """Age every cell by one frame (the end of a simulation step)."""
+        self.cells()
+        self.life -= 1
+        alive = self.life > 0
+        if not alive.all():
+            self.x, self.y, self.life = self.x[alive], self.y[alive], self.life[alive]
+
+
+def _react_sodium(grid, explosions, y0, y1, x0, x1, active=None, origin=(0, 0)):
+    """Blow up sodium in rows y0:y1, columns x0:x1 that touches water.
+
+    `origin` is the world position of grid[0, 0], for the explosion list.
+    """
+    height, width = grid.shape
+    sodium = grid[y0:y1, x0:x1] == CELL_SODIUM
+    if active is not None:
+        sodium &= active
+    if not sodium.any():
+        return
+    # water anywhere in the 8-neighbourhood, looking one cell past the region
+    wy0, wx0 = max(y0 - 1, 0), max(x0 - 1, 0)
+    water = grid[wy0:y1 + 1, wx0:x1 + 1] == CELL_WATER
+    near = water.copy()
+    near[:, 1:] |= water[:, :-1]
+    near[:, :-1] |= water[:, 1:]
+    wet = near.copy()
+    wet[1:] |= near[:-1]
+    wet[:-1] |= near[1:]
+    wet = wet[y0 - wy0:y0 - wy0 + y1 - y0, x0 - wx0:x0 - wx0 + x1 - x0]
+    ys, xs = np.nonzero((sodium & wet)[::-1])
+    # Bottom to top, left to right like the per-cell loop: an earlier blast
+    # can clear the water (or the sodium) a later candidate was reacting with.
+    r = EXPLOSION_RADIUS
+    for y, x in zip((y1 - 1 - ys).tolist(), (xs + x0).tolist()):
+        if grid[y, x] != CELL_SODIUM:
+            continue
+        if not (grid[max(y - 1, 0):y + 2, max(x - 1, 0):x + 2] == CELL_WATER).any():
+            continue
+        ex0, ex1 = max(x - r, 0), min(x + r + 1, width)
+        ey0, ey1 = max(y - r, 0), min(y + r + 1, height)
+        grid[ey0:ey1, ex0:ex1] = CELL_EMPTY
+        ys, xs = np.mgrid[ey0:ey1, ex0:ex1]
+        explosions.add(xs + origin[1], ys + origin[0])
+
+
+def _fall(grid, falls):
+    """Move every cell in `falls` down one row if it ends up with room.
+
+    Sweeping bottom to top, a falling cell moves when the cell under it is
+    empty or is itself falling, so a whole column drops as one block: the
+    cell moves iff the first non-falling cell below it is empty.
+    """
+    height = grid.shape[0]
+    # Key per cell: 2*row + 1 if occupied, so the minimum over the rows below
+    # picks the first non-falling cell and its low bit says if it is full.
+    # Falling cells (and the floor) get a key larger than any row.
+    floor = 2 * height + 1
+    rows = 2 * np.arange(height, dtype=np.int32)[:, None]
+    key = np.where(falls, floor, rows + (grid != CELL_EMPTY))
+    below = np.full(grid.shape, floor, dtype=np.int32)
+    below[:-1] = np.minimum.accumulate(key[:0:-1], axis=0)[::-1]
+    down = falls & ((below & 1) == 0)
+    moved = np.zeros_like(down)
+    moved[1:] = down[:-1]
+    new = np.where(down, np.uint8(CELL_EMPTY), grid)
+    new[1:] = np.where(moved[1:], grid[:-1], new[1:])
+    grid[...] = new
+    return moved
+
+
+def _slide(grid, movers, coin, right_first, dy):
+    """Move `movers` one column left or right (and `dy` rows down).
+
+    Each mover picks a random empty side (coin decides when both are free).
+    The two directions are then applied one after the other, re-checking
+    the target, so two cells never land on the same spot.  Returns the
+    mask of cells that arrived.
+    """
+    height, width = grid.shape
+    src = grid[:height - dy]
+    dst = grid[dy:]
+    movers = movers[:height - dy]
+    coin = coin[:height - dy]
+    left_ok = np.zeros(src.shape, dtype=bool)
+    right_ok = np.zeros(src.shape, dtype=bool)
+    left_ok[:, 1:] = dst[:, :-1] == CELL_EMPTY
+    right_ok[:, :-1] = dst[:, 1:] == CELL_EMPTY
+    go_right = movers & right_ok & (coin | ~left_ok)
+    go_left = movers & left_ok & ~go_right
+    arrived = np.zeros(grid.shape, dtype=bool)
+    for step in ((1, -1) if right_first else (-1, 1)):
+        go = go_right if step == 1 else go_left
+        if not go.any():
+            continue
+        # shift the movers onto their targets, keep the ones still free
+        target = np.zeros_like(go)
+        cells = np.zeros_like(src)
+        if step == 1:
+            target[:, 1:] = go[:, :-1]
+            cells[:, 1:] = src[:, :-1]
+        else:
+            target[:, :-1] = go[:, 1:]
+            cells[:, :-1] = src[:, 1:]
+        target &= dst == CELL_EMPTY
+        leaving = np.zeros_like(go)
+        if step == 1:
+            leaving[:, :-1] = target[:, 1:]
+        else:
+            leaving[:, 1:] = target[:, :-1]
+        np.copyto(src, CELL_EMPTY, where=leaving)
+        np.copyto(dst, cells, where=target)
+        arrived[dy:] |= target
+    return arrived
+
+
+def _step_window(win, inner, frame_count, seed, y0, x0):
+    """Fall/slide/spread pass over `win`, moving only cells under `inner`.
+
+    The rest of the window (one row below, one column either side) is only
+    a landing zone, so cells can leave the region but nothing outside it
+    is updated.  (y0, x0) is the window's position in the world.
+    """
+    noise = cell_noise(seed, frame_count, win.shape, y0, x0)
+    gate = noise >> np.uint64(40)  # 24 random bits, compared against p * 2**24
+    coin = (noise & np.uint64(1)).astype(bool)
+    snow_turn = frame_count % 2 == 0  # snow falls slowly: every other frame
+    right_first = snow_turn
+
+    sand = (win == CELL_SAND) & inner
+    sodium = (win == CELL_SODIUM) & inner
+    snow = (win == CELL_SNOW) & inner
+    falls = sand | sodium | ((win == CELL_WATER) & inner)
+    falls |= (win == CELL_DIRT) & inner & (gate < int(0.02 * (1 << 24)))
+    if snow_turn:
+        falls |= snow
+    moved = _fall(win, falls)
+
+    # whatever could not fall straight down tries the diagonals (the masks
+    # above are from before the fall; cells that moved or left are dropped)
+    resting = np.zeros_like(moved)
+    resting[:-1] = win[1:] != CELL_EMPTY
+    slides = sand | (sodium & (gate < int(0.9 * (1 << 24))))
+    if snow_turn:
+        slides |= snow & (gate < int(0.6 * (1 << 24)))
+    slides &= resting & ~moved & (win != CELL_EMPTY)
+    if slides.any():
+        moved |= _slide(win, slides, coin, right_first, 1)
+
+    # water that is resting on something spreads sideways
+    water = (win == CELL_WATER) & inner
+    water[:-1] &= win[1:] != CELL_EMPTY
+    water &= ~moved
+    if water.any():
+        _slide(win, water, coin, right_first, 0)
+
+
+def _step_region(grid, explosions, frame_count, seed, y0, y1, x0, x1, active=None, origin=(0, 0)):
+    """Step the cells in rows y0:y1, columns x0:x1 (and under `active`).
+
+    Cells may move one cell out of the rectangle and blasts reach
+    EXPLOSION_RADIUS cells past it, so `grid` needs that much room around
+    it (or the world edge).  `origin` is the world position of grid[0, 0].
+    """
+    _react_sodium(grid, explosions, y0, y1, x0, x1, active, origin)
+    _move_region(grid, frame_count, seed, y0, y1, x0, x1, active, origin)
+
+
+def _move_region(grid, frame_count, seed, y0, y1, x0, x1, active=None, origin=(0, 0)):
+    """The movement half of _step_region (everything but the blasts)."""
+    height, width = grid.shape
+    wy1, wx0, wx1 = min(y1 + 1, height), max(x0 - 1, 0), min(x1 + 1, width)
+    win = grid[y0:wy1, wx0:wx1]
+    inner = np.zeros(win.shape, dtype=bool)
+    inner[:y1 - y0, x0 - wx0:x1 - wx0] = True if active is None else active
+    _step_window(win, inner, frame_count, seed, origin[0] + y0, origin[1] + wx0)
+
+
+def update_array_grid(grid, explosions, frame_count, seed=0):
+    """One simulation step on a uint8 grid, in place."""
+    height, width = grid.shape
+    _step_region(grid, explosions, frame_count, seed, 0, height, 0, width)
+    explosions.decay()
+
+
+# === CHUNKS ===
+
+class ChunkTracker:
+    """Awake/asleep flags for `size` x `size` blocks of the grid.
+
+    Only awake chunks are stepped.  A chunk wakes when a cell in it or next
+    to it changes (or is painted) and goes back to sleep after
+    `sleep_after` frames without a change, unless something in it is still
+    hanging over an empty cell (dirt only falls 2% of the time).
+    """
+
+    def __init__(self, width, height, size=16, sleep_after=30, awake=True):
+        self.width = width
+        self.height = height
+        self.size = size
+        self.sleep_after = sleep_after
+        shape = (-(-height // size), -(-width // size))
+        self.awake = np.full(shape, awake, dtype=bool)
+        self.quiet = np.zeros(shape, dtype=np.int32)
+        self._touched = np.zeros(shape, dtype=bool)
+
+    def chunk_rect(self, cy, cx):
+        """(y0, y1, x0, x1) cells covered by chunk (cy, cx)."""
+        s = self.size
+        return cy * s, min((cy + 1) * s, self.height), cx * s, min((cx + 1) * s, self.width)
+
+    def wake(self, x0, y0, x1, y1):
+        """Cells [x0, x1) x [y0, y1) changed outside the simulation."""
+        s = self.size
+        x0, y0 = max(x0 - 1, 0), max(y0 - 1, 0)
+        x1, y1 = min(x1 + 1, self.width), min(y1 + 1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        chunks = slice(y0 // s, (y1 - 1) // s + 1), slice(x0 // s, (x1 - 1) // s + 1)
+        self._touched[chunks] = True
+        self.awake[chunks] = True
+        self.quiet[chunks] = 0
+
+    def sleep_all(self):
+        self.awake[:] = False
+        self.quiet[:] = 0
+
+    def touch(self, changed, y0=0, x0=0):
+        """Cells in the `changed` mask (top-left at y0, x0) changed: wake
+        their chunks and the chunks next to them."""
+        # grow by one cell so a change on a chunk's edge wakes the neighbour
+        near = changed.copy()
+        near[1:] |= changed[:-1]
+        near[:-1] |= changed[1:]
+        grown = near.copy()
+        grown[:, 1:] |= near[:, :-1]
+        grown[:, :-1] |= near[:, 1:]
+        s = self.size
+        rows = np.unique(np.r_[0, np.arange(-y0 % s, len(grown), s)])
+        cols = np.unique(np.r_[0, np.arange(-x0 % s, grown.shape[1], s)])
+        hit = np.logical_or.reduceat(np.logical_or.reduceat(grown, rows, axis=0), cols, axis=1)
+        cy, cx = y0 // s, x0 // s
+        self._touched[cy:cy + hit.shape[0], cx:cx + hit.shape[1]] |= hit
+        self.awake |= self._touched
+
+    def regions(self):
+        """Groups of touching awake chunks as (y0, y1, x0, x1, active).
+
+        Each group is stepped as one window (its bounding box, with a mask
+        of the awake cells, or None if all of it is awake), so a falling
+        column spanning several chunks still drops as one block.  Separate
+        groups have a sleeping chunk between them and cannot affect each
+        other within a step.
+        """
+        s = self.size
+        rows = np.flatnonzero(self.awake.any(axis=1))
+        if not len(rows):
+            return []
+        cols = np.flatnonzero(self.awake[rows[0]:rows[-1] + 1].any(axis=0))
+        oy, ox = rows[0], cols[0]
+        labels, _ = ndimage.label(self.awake[oy:rows[-1] + 1, ox:cols[-1] + 1], structure=np.ones((3, 3)))
+        out = []
+        for i, (sy, sx) in enumerate(ndimage.find_objects(labels), 1):
+            mask = labels[sy, sx] == i
+            y0, y1 = (oy + sy.start) * s, min((oy + sy.stop) * s, self.height)
+            x0, x1 = (ox + sx.start) * s, min((ox + sx.stop) * s, self.width)
+            active = mask.repeat(s, axis=0).repeat(s, axis=1)[:y1 - y0, :x1 - x0]
+            out.append((y0, y1, x0, x1, None if mask.all() else active))
+        return out
+
+    def settle(self, grid):
+        """End of a step: count quiet frames and put idle chunks to sleep."""
+        idle = self.awake & ~self._touched
+        self.quiet[self._touched] = 0
+        self.quiet[idle] += 1
+        for cy, cx in np.argwhere(idle & (self.quiet >= self.sleep_after)).tolist():
+            y0, y1, x0, x1 = self.chunk_rect(cy, cx)
+            # row below each cell; one row short at the bottom of the world
+            under = grid[y0 + 1:y1 + 1, x0:x1] == CELL_EMPTY
+            if ((grid[y0:y0 + len(under), x0:x1] != CELL_EMPTY) & under).any():
+                continue
+            self.awake[cy, cx] = False
+        self._touched[:] = False
+
+    def wake_stacks(self, grid):
+        """Wake sleeping chunks that rest on an awake one.
+
+        A column falls as one block, so whatever is stacked on an awake
+        chunk has to be stepped with it; rows are walked bottom to top to
+        wake whole stacks.
+        """
+        s = self.size
+        for cy in range(self.awake.shape[0] - 1, 0, -1):
+            for cx in np.flatnonzero(self.awake[cy] & ~self.awake[cy - 1]).tolist():
+                if (grid[cy * s - 1:cy * s, cx * s:min((cx + 1) * s, self.width)] != CELL_EMPTY).any():
+                    self.awake[cy - 1, cx] = True
+                    self.quiet[cy - 1, cx] = 0
+
+
+class ChunkedWorld:
+    """A grid too big to allocate, stored as `size` x `size` chunks.
+
+    Chunks are allocated the first time something non-empty is written to
+    them and dropped again when they become empty, so memory follows the
+    painted area.  pack_idle() zlib-compresses chunks far from the view
+    that are asleep; a packed chunk is unpacked the next time it is read
+    or written.  Slicing (world[y0:y1, x0:x1]) returns a copy.
+    """
+
+    def __init__(self, width, height, size=64):
+        self.width = width
+        self.height = height
+        self.size = size
+        self.shape = (height, width)
+        self.chunks = {}  # (cy, cx) -> (size, size) uint8 array
+        self.packed = {}  # (cy, cx) -> zlib-compressed chunk
+        self.mapping = None  # the save file load_world() mapped, packed chunks point into it
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.chunks.values()) + sum(len(p) for p in self.packed.values())
+
+    def clear(self):
+        self.chunks.clear()
+        self.packed.clear()
+        self.detach()
+
+    def detach(self):
+        """Copy packed chunks out of the mapped save file and close it.
+
+        Windows can't replace a file that is mapped, so this has to happen
+        before saving over the file the world was loaded from."""
+        if self.mapping is None:
+            return
+        for key, blob in self.packed.items():
+            if isinstance(blob, memoryview):
+                self.packed[key] = blob.tobytes()
+                blob.release()
+        self.mapping.close()
+        self.mapping = None
+
+    def _chunk(self, key, create=False):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            data = self.packed.pop(key, None)
+            if data is not None:
+                chunk = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+                chunk = self.chunks[key] = chunk.reshape(self.size, self.size).copy()
+            elif create:
+                chunk = self.chunks[key] = np.zeros((self.size, self.size), dtype=np.uint8)
+        return chunk
+
+    def _spans(self, y0, y1, x0, x1):
+        """(key, chunk slices, rect slices) for each chunk a rectangle covers."""
+        s = self.size
+        for cy in range(y0 // s, (y1 - 1) // s + 1):
+            cy0, cy1 = max(y0, cy * s), min(y1, (cy + 1) * s)
+            for cx in range(x0 // s, (x1 - 1) // s + 1):
+                cx0, cx1 = max(x0, cx * s), min(x1, (cx + 1) * s)
+                yield ((cy, cx),
+                       (slice(cy0 - cy * s, cy1 - cy * s), slice(cx0 - cx * s, cx1 - cx * s)),
+                       (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0)))
+
+    def _clip(self, y0, y1, x0, x1):
+        return max(y0, 0), min(y1, self.height), max(x0, 0), min(x1, self.width)
+
+    def read(self, y0, y1, x0, x1):
+        y0, y1, x0, x1 = self._clip(y0, y1, x0, x1)
+        out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint8)
+        if out.size:
+            for key, inside, rect in self._spans(y0, y1, x0, x1):
+                chunk = self._chunk(key)
+                if chunk is not None:
+                    out[rect] = chunk[inside]
+        return out
+
+    def __getitem__(self, key):
+        ys, xs = key
+        y0, y1, _ = ys.indices(self.height)
+        x0, x1, _ = xs.indices(self.width)
+        return self.read(y0, y1, x0, x1)
+
+    def write(self, y0, x0, block):
+        """Copy `block` into the world with its top-left cell at (y0, x0)."""
+        self._store(y0, y0 + block.shape[0], x0, x0 + block.shape[1], block, y0, x0)
+
+    def fill(self, y0, y1, x0, x1, cell):
+        """Set every cell of a rectangle (clipped to the world) to `cell`."""
+        self._store(y0, y1, x0, x1, cell)
+
+    def _store(self, y0, y1, x0, x1, value, by0=None, bx0=None):
+        cy0, cy1, cx0, cx1 = self._clip(y0, y1, x0, x1)
+        if cy0 >= cy1 or cx0 >= cx1:
+            return
+        block = isinstance(value, np.ndarray)
+        if block:
+            value = value[cy0 - by0:cy1 - by0, cx0 - bx0:cx1 - bx0]
+        for key, inside, rect in self._spans(cy0, cy1, cx0, cx1):
+            part = value[rect] if block else value
+            chunk = self._chunk(key, create=bool(np.any(part)))
+            if chunk is None:
+                continue
+            chunk[inside] = part
+            if not chunk.any():
+                del self.chunks[key]
+
+    def pack_idle(self, tracker, view, margin=1):
+        """Compress chunks that are asleep and more than `margin` chunks
+        away from `view` (y0, y1, x0, x1 in cells)."""
+        s, t = self.size, tracker.size
+        vy0, vy1, vx0, vx1 = view
+        for key in list(self.chunks):
+            cy, cx = key
+            if (vy0 // s - margin <= cy <= (vy1 - 1) // s + margin
+                    and vx0 // s - margin <= cx <= (vx1 - 1) // s + margin):
+                continue
+            # the tracker chunks covering this chunk's cells, whatever their size
+            y0, y1, x0, x1 = cy * s, min((cy + 1) * s, self.height), cx * s, min((cx + 1) * s, self.width)
+            if tracker.awake[y0 // t:(y1 - 1) // t + 1, x0 // t:(x1 - 1) // t + 1].any():
+                continue
+            self.packed[key] = zlib.compress(self.chunks.pop(key).tobytes(), 1)
+
+
+def _windows(grid, tracker):
+    """(region, window origin, window) for each group of awake chunks.
+
+    The region (y0, y1, x0, x1, active) is relative to the window, which
+    reaches as far around it as a step can change cells: one cell for a
+    move, EXPLOSION_RADIUS for a blast.  For a ChunkedWorld the window is
+    a copy, for an array a view.  Windows can overlap, so a copy is only
+    read once the caller has written back the one before it.
+    """
+    world = grid if isinstance(grid, ChunkedWorld) else None
+    height, width = grid.shape
+    pad = EXPLOSION_RADIUS + 1
+    for y0, y1, x0, x1, active in tracker.regions():
+        wy0, wy1 = max(y0 - pad, 0), min(y1 + pad, height)
+        wx0, wx1 = max(x0 - pad, 0), min(x1 + pad, width)
+        win = world.read(wy0, wy1, wx0, wx1) if world else grid[wy0:wy1, wx0:wx1]
+        yield (y0 - wy0, y1 - wy0, x0 - wx0, x1 - wx0, active), (wy0, wx0), win
+
+
+def update_chunks(grid, explosions, frame_count, tracker, seed=0):
+    """update_array_grid over the awake chunks of `tracker` only.
+
+    `grid` is a uint8 array or a ChunkedWorld; for a world each group of
+    awake chunks is read into a small array, stepped and written back.
+    The result is the same as update_array_grid's as long as everything
+    that could move is awake.
+    """
+    world = grid if isinstance(grid, ChunkedWorld) else None
+    tracker.wake_stacks(grid)
+    # Blasts come first, everywhere, as in update_array_grid: they can free
+    # cells in sleeping chunks, and those have to move in this same step.
+    blasted = False
+    for (y0, y1, x0, x1, active), (wy0, wx0), win in _windows(grid, tracker):
+        blasts = Explosions()
+        _react_sodium(win, blasts, y0, y1, x0, x1, active, (wy0, wx0))
+        if len(blasts):
+            blasted = True
+            explosions.extend(blasts)
+            cleared = np.zeros(win.shape, dtype=bool)
+            ex, ey, _ = blasts.cells()
+            cleared[ey - wy0, ex - wx0] = True
+            tracker.touch(cleared, wy0, wx0)
+            if world:
+                world.write(wy0, wx0, win)
+    if blasted:
+        tracker.wake_stacks(grid)
+
+    for (y0, y1, x0, x1, active), (wy0, wx0), win in _windows(grid, tracker):
+        old = win.copy()
+        _move_region(win, frame_count, seed, y0, y1, x0, x1, active, (wy0, wx0))
+        changed = win != old
+        if changed.any():
+            if world:
+                world.write(wy0, wx0, win)
+            tracker.touch(changed, wy0, wx0)
+    explosions.decay()
+    tracker.settle(grid)
+
+
+# === BRUSH ===
+
+def stroke_spans(x0, y0, x1, y1, radius, round_brush=False, width=None, height=None):
+    """The cells a brush covers when dragged from (x0, y0) to (x1, y1).
+
+    A square brush covers |dx|, |dy| <= radius around its centre, a round
+    one dx^2 + dy^2 <= radius^2 + radius.  The brush is stamped at every
+    cell along the segment, so a fast stroke has no gaps.  Either shape
+    swept along a line is convex, so each row is one run of cells: the
+    result is (ys, lo, hi) with row ys[i] covered for lo[i] <= x < hi[i],
+    clipped to width x height when given.
+    """
+    steps = max(abs(x1 - x0), abs(y1 - y0))
+    t = np.linspace(0, 1, steps + 1)
+    cx = np.rint(x0 + (x1 - x0) * t).astype(np.int64)
+    cy = np.rint(y0 + (y1 - y0) * t).astype(np.int64)
+    dy = np.arange(-radius, radius + 1)
+    if round_brush:
+        half = np.sqrt(radius * radius + radius - dy * dy).astype(np.int64)
+    else:
+        half = np.full(len(dy), radius)
+    rows = (cy[:, None] + dy).ravel()
+    top = rows.min()
+    ys = np.arange(top, rows.max() + 1)
+    lo = np.full(len(ys), np.iinfo(np.int64).max)
+    hi = np.full(len(ys), np.iinfo(np.int64).min)
+    np.minimum.at(lo, rows - top, (cx[:, None] - half).ravel())
+    np.maximum.at(hi, rows - top, (cx[:, None] + half + 1).ravel())
+    if width is not None:
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, width)
+    keep = lo < hi
+    if height is not None:
+        keep &= (ys >= 0) & (ys < height)
+    return ys[keep], lo[keep], hi[keep]
+
+
+def paint_spans(grid, spans, cell):
+    """Set the cells of stroke_spans() to `cell`.
+
+    `grid` is a uint8 array, a ChunkedWorld or a list of rows.  Returns
+    the painted rectangle as (x0, y0, x1, y1), or None if it was empty.
+    """
+    ys, lo, hi = spans
+    if not len(ys):
+        return None
+    y0, y1, x0, x1 = int(ys[0]), int(ys[-1]) + 1, int(lo.min()), int(hi.max())
+    if isinstance(grid, list):
+        for y, a, b in zip(ys.tolist(), lo.tolist(), hi.tolist()):
+            grid[y][a:b] = [cell] * (b - a)
+        return x0, y0, x1, y1
+    xs = np.arange(x0, x1)
+    mask = (xs >= lo[:, None]) & (xs < hi[:, None])
+    if isinstance(grid, ChunkedWorld):
+        block = grid.read(y0, y1, x0, x1)
+        block[mask] = cell
+        grid.write(y0, x0, block)
+    else:
+        grid[y0:y1, x0:x1][mask] = cell
+    return x0, y0, x1, y1
+
+
+# === STRIPS ===
+
+STRIP_MARGIN = EXPLOSION_RADIUS + 1  # columns a strip reads/writes past its edges
+
+
+def strip_bounds(width, strips):
+    """Column edges of `strips` vertical strips (the last one takes the rest)."""
+    strips = max(1, min(strips, width // (2 * STRIP_MARGIN + 2)))
+    return np.linspace(0, width, strips + 1).astype(np.int64)
+
+
+def _step_strip(grid, arrived, explosions, frame_count, seed, x0, x1, first_phase):
+    """Step columns x0:x1 of `grid` in place (a view into shared memory).
+
+    Cells a strip pushes over its edges land in a strip of the other
+    phase.  In the first phase they are flagged in `arrived`; the second
+    phase leaves flagged cells alone, so no cell moves twice in a frame.
+    """
+    height, width = grid.shape
+    wx0, wx1 = max(x0 - STRIP_MARGIN, 0), min(x1 + STRIP_MARGIN, width)
+    win = grid[:, wx0:wx1]
+    edges = [x for x in (x0 - 1, x1) if 0 <= x < width]
+    before = grid[:, edges].copy()
+    active = None if first_phase else arrived[:, x0:x1] == 0
+    _step_region(win, explosions, frame_count, seed, 0, height, x0 - wx0, x1 - wx0, active, (0, wx0))
+    if first_phase:
+        for i, x in enumerate(edges):
+            # halo cells only change by a blast (to empty) or by something moving in
+            arrived[:, x] = (grid[:, x] != before[:, i]) & (grid[:, x] != CELL_EMPTY)
+
+
+def step_strips(grid, arrived, bounds, explosions, frame_count, seed=0):
+    """What StripStepper.step computes, in this process (one strip at a time)."""
+    arrived[:] = 0
+    for phase in (0, 1):
+        for s in range(phase, len(bounds) - 1, 2):
+            _step_strip(grid, arrived, explosions, frame_count, seed, bounds[s], bounds[s + 1], phase == 0)
+    explosions.decay()
+
+
+def _strip_worker(conn, names, shape, strips, seed):
+    """Steps its strips (one even, one odd) whenever the parent asks."""
+    grid_shm, arrived_shm = (shared_memory.SharedMemory(name=name) for name in names)
+    grid = np.ndarray(shape, dtype=np.uint8, buffer=grid_shm.buf)
+    arrived = np.ndarray(shape, dtype=np.uint8, buffer=arrived_shm.buf)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        frame_count, phase = msg
+        explosions = Explosions()
+        t = time.perf_counter()
+        for x0, x1 in strips[phase]:
+            _step_strip(grid, arrived, explosions, frame_count, seed, x0, x1, phase == 0)
+        conn.send((explosions.cells(), time.perf_counter() - t))
+    del grid, arrived
+    for shm in (grid_shm, arrived_shm):
+        shm.close()
+
+
+class StripStepper:
+    """Steps a whole grid on several cores.
+
+    The grid lives in shared memory and is cut into 2 * `workers` vertical
+    strips.  Each frame runs in two phases: first every even strip, in
+    parallel, then every odd strip.  Strips of the same phase are at least
+    a strip apart, so they never touch the same cells, and a cell pushed
+    into the neighbouring strip is not moved again there (see _step_strip).
+
+    Randomness is keyed on world coordinates, so the result for a seed
+    does not depend on timing; it matches step_strips() with the same
+    bounds.  worker_ms holds each worker's step time for the last frame.
+    """
+
+    def __init__(self, width, height, workers=None, seed=0):
+        workers = max(1, int(workers or os.cpu_count() or 1))
+        self.bounds = strip_bounds(width, 2 * workers)
+        shape = (height, width)
+        self._shm = [shared_memory.SharedMemory(create=True, size=max(1, width * height)) for _ in range(2)]
+        self.grid = np.ndarray(shape, dtype=np.uint8, buffer=self._shm[0].buf)
+        self.grid[:] = CELL_EMPTY
+        self._arrived = np.ndarray(shape, dtype=np.uint8, buffer=self._shm[1].buf)
+        names = [shm.name for shm in self._shm]
+        strips = [(int(self.bounds[s]), int(self.bounds[s + 1])) for s in range(len(self.bounds) - 1)]
+        # worker w gets strips 2w (even phase) and 2w + 1 (odd phase)
+        jobs = [(strips[2 * w:2 * w + 1], strips[2 * w + 1:2 * w + 2]) for w in range(-(-len(strips) // 2))]
+        # the first-phase strips' edge columns, where `arrived` is written
+        self._edges = [x for x0, x1 in strips[::2] for x in (x0 - 1, x1) if 0 <= x < width]
+
+        self._conns = []
+        self._procs = []
+        for job in jobs:
+            parent, child = mp.Pipe()
+            proc = mp.Process(target=_strip_worker, daemon=True, args=(child, names, shape, job, seed))
+            proc.start()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        self.worker_ms = [0.0] * len(self._conns)
+
+    @property
+    def workers(self):
+        return len(self._conns)
+
+    def step(self, explosions, frame_count):
+        self._arrived[:, self._edges] = 0
+        times = [0.0] * self.workers
+        for phase in (0, 1):
+            busy = [w for w in range(self.workers) if phase == 0 or 2 * w + 1 < len(self.bounds) - 1]
+            for w in busy:
+                self._conns[w].send((frame_count, phase))
+            for w in busy:
+                found, elapsed = self._conns[w].recv()
+                explosions.add(found[0], found[1])
+                times[w] += elapsed
+        explosions.decay()
+        self.worker_ms = [1000 * t for t in times]
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, EOFError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._conns, self._procs = [], []
+        self.grid = self._arrived = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# === SAVES ===
+#
+# A save file is, in order:
+#   header      SAVE_HEADER below
+#   index       one SAVE_INDEX record per stored chunk, sorted by (cy, cx)
+#   explosions  int32 (x, y, life) triples
+#   awake       np.packbits of the tracker's awake flags (empty without one)
+#   chunks      zlib-compressed `size` x `size` uint8 chunks
+# Empty chunks are not stored.  Loading maps the file and only parses the
+# header and index; each chunk is decompressed the first time it is read.
+
+SAVE_MAGIC = b"SBXW"
+SAVE_VERSION = 1
+# magic, version, chunk size, tracker chunk size (0: no tracker), width, height,
+# stored chunks, explosions
+SAVE_HEADER = struct.Struct("<4sHHHxxIIII")
+SAVE_INDEX = np.dtype([("cy", "<u4"), ("cx", "<u4"), ("offset", "<u8"), ("length", "<u4")])
+
+
+def _dense_chunks(grid, size):
+    """zlib blobs of the non-empty `size` x `size` chunks of a uint8 array."""
+    height, width = grid.shape
+    ny, nx = -(-height // size), -(-width // size)
+    padded = np.zeros((ny * size, nx * size), dtype=np.uint8)
+    padded[:height, :width] = grid
+    blocks = padded.reshape(ny, size, nx, size).swapaxes(1, 2)
+    return {(int(cy), int(cx)): zlib.compress(blocks[cy, cx].tobytes(), 1)
+            for cy, cx in zip(*np.nonzero(blocks.any(axis=(2, 3))))}
+
+
+def save_world(path, grid, explosions, tracker=None, size=64):
+    """Write `grid` (a uint8 array or a ChunkedWorld) and `explosions` to `path`.
+
+    A world keeps its own chunk size and its already packed chunks are
+    written as they are.  With a `tracker` its awake chunks are saved too,
+    so a loaded world carries on where it stopped.
+    """
+    if isinstance(grid, ChunkedWorld):
+        grid.detach()
+        size = grid.size
+        blobs = dict(grid.packed)
+        blobs.update((key, zlib.compress(chunk.tobytes(), 1)) for key, chunk in grid.chunks.items())
+    else:
+        grid = np.asarray(grid, dtype=np.uint8)
+        blobs = _dense_chunks(grid, size)
+    height, width = grid.shape
+    keys = sorted(blobs)
+    boom = np.column_stack(explosions.cells()).astype("<i4").reshape(-1, 3)
+    awake = np.packbits(tracker.awake) if tracker else np.zeros(0, dtype=np.uint8)
+
+    index = np.zeros(len(keys), dtype=SAVE_INDEX)
+    index["cy"], index["cx"] = [k[0] for k in keys], [k[1] for k in keys]
+    index["length"] = [len(blobs[k]) for k in keys]
+    start = SAVE_HEADER.size + index.nbytes + boom.nbytes + awake.nbytes
+    index["offset"] = start + np.concatenate(([0], np.cumsum(index["length"], dtype=np.uint64)[:-1]))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, size, tracker.size if tracker else 0,
+                                 width, height, len(keys), len(boom)))
+        f.write(index.tobytes())
+        f.write(boom.tobytes())
+        f.write(awake.tobytes())
+        for key in keys:
+            f.write(blobs[key])
+    os.replace(tmp, path)
+
+
+def load_world(path):
+    """Open a save file as (ChunkedWorld, explosions, awake).
+
+    The file is memory-mapped and every chunk starts out packed, pointing
+    into the mapping, so opening costs the same for any world size and
+    only the chunks that get looked at are ever decompressed.  `awake` is
+    the saved tracker's (rows, cols) awake flags, or None.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < SAVE_HEADER.size:
+        raise ValueError(f"{path}: not a sandbox save")
+    magic, version, size, tsize, width, height, count, booms = SAVE_HEADER.unpack_from(data)
+    if magic != SAVE_MAGIC:
+        raise ValueError(f"{path}: not a sandbox save")
+    if version != SAVE_VERSION:
+        raise ValueError(f"{path}: save version {version} is not supported")
+
+    at = SAVE_HEADER.size
+    index = np.frombuffer(data, dtype=SAVE_INDEX, count=count, offset=at)
+    at += index.nbytes
+    explosions = Explosions()
+    explosions.extend(np.frombuffer(data, dtype="<i4", count=3 * booms, offset=at).reshape(-1, 3))
+    at += 12 * booms
+    awake = None
+    if tsize:
+        shape = (-(-height // tsize), -(-width // tsize))
+        bits = np.frombuffer(data, dtype=np.uint8, count=-(-shape[0] * shape[1] // 8), offset=at)
+        awake = np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+    world = ChunkedWorld(width, height, size)
+    world.mapping = data
+    with memoryview(data) as view:
+        world.packed = {(cy, cx): view[off:off + n] for cy, cx, off, n in index.tolist()}
+    return world, explosions, awake
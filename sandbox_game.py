@@ -1,25 +1,25 @@
+import argparse
+import functools
 import pygame
 import random
 import sys
 
+import numpy as np
+
+from sandbox_engine import (CELL_DIRT, CELL_EMPTY, CELL_SAND, CELL_SNOW, CELL_SODIUM, CELL_WATER, COLORS,
+                            ChunkedWorld, ChunkTracker, Explosions, StripStepper, load_world, paint_spans,
+                            palette_lut, save_world, stroke_spans, update_chunks)
+
 # Simple sandbox physics game
 # Elements: empty=0, sand=1, water=2, sodium=3, dirt=4, snow=5
-
-CELL_EMPTY = 0
-CELL_SAND = 1
-CELL_WATER = 2
-CELL_SODIUM = 3
-CELL_DIRT = 4
-CELL_SNOW = 5
-
-COLORS = {
-    CELL_EMPTY: (10, 10, 10),
-    CELL_SAND: (194, 178, 128),
-    CELL_WATER: (64, 164, 223),
-    CELL_SODIUM: (240, 240, 240),
-    CELL_DIRT: (106, 55, 5),
-    CELL_SNOW: (230, 250, 250),
-}
+#
+# Two simulation backends, picked with --backend: "python" (the default) is
+# the original per-cell loop below, "numpy" runs the same rules as whole-array
+# passes on a uint8 grid (see sandbox_engine.py).  It has no left-to-right
+# drift, so piles settle differently than in the loop.  The numpy backend also
+# splits the world into chunks and only steps the awake ones, which is what
+# makes --world sizes far bigger than the screen possible.  With --workers N
+# the whole (dense) world is stepped on N cores instead, in vertical strips.
 
 WIDTH_CELLS = 200
 HEIGHT_CELLS = 150
@@ -30,6 +30,15 @@ SCREEN_H = HEIGHT_CELLS * CELL_SIZE
 
 FPS = 60
 
+CHUNK_SIZE = 16
+CAMERA_SPEED = 8  # cells per frame with the arrow keys (x4 with shift)
+PACK_EVERY = 60  # frames between compressing far away sleeping chunks
+SAVE_FILE = "sandbox.sbw"
+NOTICE_FRAMES = 120  # how long save/load messages stay in the status line
+
+PALETTE = palette_lut(COLORS)
+EXPLOSION_COLOR = (255, 80, 0)
+
 def make_grid():
     return [[CELL_EMPTY for _ in range(WIDTH_CELLS)] for _ in range(HEIGHT_CELLS)]
 
@@ -122,33 +131,35 @@ def update_grid(grid, explosions, frame_count):
                         swap(grid, x, y, nx, ny)
 
     # decay explosions
-    for ex in explosions[:]:
-        ex[2] -= 1
-        if ex[2] <= 0:
-            explosions.remove(ex)
-
-def draw_grid(screen, grid, explosions):
-    for y in range(HEIGHT_CELLS):
-        row = grid[y]
-        for x in range(WIDTH_CELLS):
-            color = COLORS.get(row[x], (255, 0, 255))
-            rect = pygame.Rect(x*CELL_SIZE, y*CELL_SIZE, CELL_SIZE, CELL_SIZE)
-            screen.fill(color, rect)
+    explosions.decay()
+
+def draw_grid(screen, cells, grid, explosions, x0=0, y0=0):
+    """Draw the grid through PALETTE into `cells` and scale that onto the screen.
+
+    `cells` is a surface with one pixel per cell and `grid` the part of the
+    world it shows, whose top-left cell is (x0, y0).
+    """
+    pixels = pygame.surfarray.pixels3d(cells)  # indexed [x, y]
+    pixels[...] = PALETTE[np.asarray(grid, dtype=np.uint8).T]
     # draw explosions as red flashes
-    for (ex, ey, life) in explosions:
-        alpha = max(0, min(255, int(255 * (life / 8))))
-        color = (255, 80, 0)
-        rect = pygame.Rect(ex*CELL_SIZE, ey*CELL_SIZE, CELL_SIZE, CELL_SIZE)
-        screen.fill(color, rect)
+    if len(explosions):
+        fx, fy, _ = explosions.cells()
+        fx, fy = fx - x0, fy - y0
+        seen = (fx >= 0) & (fx < pixels.shape[0]) & (fy >= 0) & (fy < pixels.shape[1])
+        pixels[fx[seen], fy[seen]] = EXPLOSION_COLOR
+    del pixels  # unlock the surface
+    pygame.transform.scale(cells, screen.get_size(), screen)
 
-def draw_ui(screen, selected, brush_size, paused):
+def draw_ui(screen, selected, brush_size, paused, status=None, round_brush=False):
     font = pygame.font.get_default_font()
     f = pygame.font.Font(font, 14)
     lines = [
         f"Selected: {selected}  (1:Sand 2:Water 3:Sodium 4:Dirt 5:Snow)",
-        f"Brush: {brush_size}  (Use mouse, +/- to change)",
-        f"Space: Pause ({'Paused' if paused else 'Running'})  C:Clear  Right-click: Erase",
+        f"Brush: {brush_size} {'round' if round_brush else 'square'}  (Use mouse, +/- to change, B: shape)",
+        f"Space: Pause ({'Paused' if paused else 'Running'})  C:Clear  Right-click: Erase  S:Save  L:Load",
     ]
+    if status:
+        lines.append(status)
     y = 6
     for line in lines:
         surf = f.render(line, True, (240,240,240))
@@ -159,20 +170,89 @@ def element_code_from_index(idx):
     mapping = {1: CELL_SAND, 2: CELL_WATER, 3: CELL_SODIUM, 4: CELL_DIRT, 5: CELL_SNOW}
     return mapping.get(idx, CELL_SAND)
 
+def load_save(path, width, height, dense):
+    """(grid, explosions, awake) from a save file made with S.
+
+    The grid is a ChunkedWorld, or a uint8 array if `dense`.  Raises
+    ValueError if the saved world is not width x height.
+    """
+    world, explosions, awake = load_world(path)
+    if world.shape != (height, width):
+        raise ValueError(f"{path} holds a {world.width}x{world.height} world, this one is {width}x{height}")
+    return (world.read(0, height, 0, width) if dense else world), explosions, awake
+
 def main():
+    parser = argparse.ArgumentParser(description="Sandbox physics game")
+    parser.add_argument("--backend", choices=("python", "numpy"), default="python",
+                        help="simulation backend (default: python); numpy is much faster but has no "
+                             "left-to-right drift, so piles settle differently")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the simulation")
+    parser.add_argument("--world", metavar="WxH",
+                        help=f"world size in cells (numpy backend, default {WIDTH_CELLS}x{HEIGHT_CELLS}); "
+                             "bigger worlds scroll with the arrow keys")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="numpy backend: size of the chunks that sleep while nothing in them moves")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="numpy backend: step the whole world on this many processes "
+                             "(replaces chunk sleeping)")
+    parser.add_argument("--file", default=SAVE_FILE, help=f"where S saves and L loads the world (default {SAVE_FILE})")
+    parser.add_argument("--load", metavar="PATH", help="start from a saved world (numpy backend: of any size)")
+    args = parser.parse_args()
+    if args.workers and args.backend != "numpy":
+        parser.error("--workers needs the numpy backend")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    world_w, world_h = WIDTH_CELLS, HEIGHT_CELLS
+    if args.world:
+        if args.backend != "numpy":
+            parser.error("--world needs the numpy backend")
+        try:
+            world_w, world_h = (int(v) for v in args.world.lower().split("x"))
+        except ValueError:
+            parser.error("--world must look like 4000x4000")
+        if world_w < WIDTH_CELLS or world_h < HEIGHT_CELLS:
+            parser.error(f"--world must be at least {WIDTH_CELLS}x{HEIGHT_CELLS}")
+    if args.load and args.backend == "numpy":
+        try:
+            world_h, world_w = load_world(args.load)[0].shape
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if world_w < WIDTH_CELLS or world_h < HEIGHT_CELLS:
+            parser.error(f"{args.load}: worlds smaller than {WIDTH_CELLS}x{HEIGHT_CELLS} can't be shown")
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    random.seed(seed)
+    tracker = stepper = None
+    if args.workers > 0:
+        stepper = StripStepper(world_w, world_h, args.workers, seed)
+        grid = stepper.grid
+        step = lambda grid, explosions, frame_count: stepper.step(explosions, frame_count)
+    elif args.backend == "numpy":
+        grid = ChunkedWorld(world_w, world_h)
+        tracker = ChunkTracker(world_w, world_h, args.chunk_size, awake=False)
+        step = functools.partial(update_chunks, tracker=tracker, seed=seed)
+    else:
+        grid = make_grid()
+        step = update_grid
+    # top-left cell of the view, starting at the bottom middle of the world
+    cam_x, cam_y = (world_w - WIDTH_CELLS) // 2, world_h - HEIGHT_CELLS
+
     pygame.init()
     screen = pygame.display.set_mode((SCREEN_W, SCREEN_H))
     pygame.display.set_caption('Sandbox Physics')
     clock = pygame.time.Clock()
+    cells = pygame.Surface((WIDTH_CELLS, HEIGHT_CELLS))
 
-    grid = make_grid()
-    explosions = []
+    explosions = Explosions()
     running = True
     paused = False
     selected_idx = 1
     selected = element_code_from_index(selected_idx)
     brush = 4
+    round_brush = False
+    last_paint = None  # where the brush was last frame, to join up fast strokes
     frame_count = 0
+    loading = args.load
+    notice, notice_until = None, 0
 
     while running:
         frame_count += 1
@@ -185,44 +265,108 @@ def main():
                 elif event.key == pygame.K_SPACE:
                     paused = not paused
                 elif event.key == pygame.K_c:
-                    grid = make_grid()
+                    if stepper:
+                        grid[:] = CELL_EMPTY
+                    elif tracker:
+                        grid.clear()
+                        tracker.sleep_all()
+                    else:
+                        grid = make_grid()
                 elif event.key == pygame.K_PLUS or event.key == pygame.K_EQUALS:
                     brush = min(32, brush + 1)
                 elif event.key == pygame.K_MINUS:
                     brush = max(1, brush - 1)
+                elif event.key == pygame.K_b:
+                    round_brush = not round_brush
                 elif event.key in (pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4, pygame.K_5):
                     selected_idx = int(event.unicode)
                     selected = element_code_from_index(selected_idx)
+                elif event.key == pygame.K_s:
+                    try:
+                        save_world(args.file, grid, explosions, tracker)
+                        notice = f"Saved to {args.file}"
+                    except OSError as e:
+                        notice = f"Save failed: {e}"
+                    notice_until = frame_count + NOTICE_FRAMES
+                elif event.key == pygame.K_l:
+                    loading = args.file
+
+        if loading:
+            try:
+                loaded, loaded_explosions, awake = load_save(loading, world_w, world_h, tracker is None)
+            except (OSError, ValueError) as e:
+                notice = f"Load failed: {e}"
+            else:
+                explosions = loaded_explosions
+                if stepper:
+                    grid[:] = loaded
+                elif tracker:
+                    grid = loaded
+                    if awake is not None and awake.shape == tracker.awake.shape:
+                        tracker.sleep_all()
+                        tracker.awake[:] = awake
+                    else:
+                        # saved without (or with differently sized) chunk flags
+                        tracker.sleep_all()
+                        for cy, cx in grid.packed:
+                            tracker.wake(cx * grid.size, cy * grid.size, (cx + 1) * grid.size, (cy + 1) * grid.size)
+                else:
+                    grid = loaded.tolist()
+                notice = f"Loaded {loading}"
+            notice_until = frame_count + NOTICE_FRAMES
+            loading = None
+
+        keys = pygame.key.get_pressed()
+        speed = CAMERA_SPEED * (4 if keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT] else 1)
+        cam_x += (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]) * speed
+        cam_y += (keys[pygame.K_DOWN] - keys[pygame.K_UP]) * speed
+        cam_x = max(0, min(cam_x, world_w - WIDTH_CELLS))
+        cam_y = max(0, min(cam_y, world_h - HEIGHT_CELLS))
 
         mouse_pressed = pygame.mouse.get_pressed()
         mx, my = pygame.mouse.get_pos()
-        grid_x = mx // CELL_SIZE
-        grid_y = my // CELL_SIZE
-
-        if mouse_pressed[0]:
-            # draw selected
-            for dx in range(-brush+1, brush):
-                for dy in range(-brush+1, brush):
-                    nx, ny = grid_x + dx, grid_y + dy
-                    if in_bounds(nx, ny):
-                        grid[ny][nx] = selected
-        if mouse_pressed[2]:
-            # erase
-            for dx in range(-brush+1, brush):
-                for dy in range(-brush+1, brush):
-                    nx, ny = grid_x + dx, grid_y + dy
-                    if in_bounds(nx, ny):
-                        grid[ny][nx] = CELL_EMPTY
+        grid_x = cam_x + mx // CELL_SIZE
+        grid_y = cam_y + my // CELL_SIZE
+
+        if mouse_pressed[0] or mouse_pressed[2]:
+            # right button (erase) wins when both are held
+            cell = CELL_EMPTY if mouse_pressed[2] else selected
+            x0, y0 = last_paint or (grid_x, grid_y)
+            spans = stroke_spans(x0, y0, grid_x, grid_y, brush - 1, round_brush, world_w, world_h)
+            painted = paint_spans(grid, spans, cell)
+            if tracker and painted:
+                tracker.wake(*painted)
+            last_paint = (grid_x, grid_y)
+        else:
+            last_paint = None
 
         if not paused:
-            update_grid(grid, explosions, frame_count)
+            step(grid, explosions, frame_count)
 
-        draw_grid(screen, grid, explosions)
-        draw_ui(screen, ['Sand','Water','Sodium','Dirt','Snow'][selected_idx-1], brush, paused)
+        status = None
+        if stepper:
+            status = (f"World {world_w}x{world_h} at {cam_x},{cam_y}  {stepper.workers} workers: "
+                      + " ".join(f"{ms:.1f}" for ms in stepper.worker_ms) + " ms")
+            draw_grid(screen, cells, grid[cam_y:cam_y + HEIGHT_CELLS, cam_x:cam_x + WIDTH_CELLS],
+                      explosions, cam_x, cam_y)
+        elif tracker:
+            view = (cam_y, cam_y + HEIGHT_CELLS, cam_x, cam_x + WIDTH_CELLS)
+            if frame_count % PACK_EVERY == 0:
+                grid.pack_idle(tracker, view)
+            status = (f"World {world_w}x{world_h} at {cam_x},{cam_y} (arrows scroll)  "
+                      f"{len(grid.chunks)}+{len(grid.packed)} packed chunks, {grid.nbytes // 1024} KB")
+            draw_grid(screen, cells, grid.read(*view), explosions, cam_x, cam_y)
+        else:
+            draw_grid(screen, cells, grid, explosions)
+        if frame_count < notice_until:
+            status = notice
+        draw_ui(screen, ['Sand','Water','Sodium','Dirt','Snow'][selected_idx-1], brush, paused, status, round_brush)
 
         pygame.display.flip()
         clock.tick(FPS)
 
+    if stepper:
+        stepper.close()
     pygame.quit()
     sys.exit()
 